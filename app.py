@@ -2,12 +2,15 @@ import gradio as gr
 import pandas as pd
 import logging
 import os
+import shutil
+import tempfile
+from contextlib import contextmanager
 from logger import setup_logger
 from processors.standard_processor import StandardProcessor
 from processors.full_format_processor import FullFormatProcessor
 import threading
 import time
-from tqdm.auto import tqdm
+import weakref
 
 
 
@@ -15,127 +18,148 @@ from tqdm.auto import tqdm
 logger = setup_logger("app")
 
 
-# Global event for stopping processing
-stop_event = threading.Event()
+# Флаги остановки выполняемых обработок: по одному на сессию пользователя и вкладку
+stop_events = weakref.WeakValueDictionary()
 
-# Создаем класс для интеграции tqdm с Gradio
-class GradioTQDM:
-    def __init__(self, progress_component):
-        self.progress_component = progress_component
-        self.total = 100
-        self.n = 0
-        self.description = ""
-        
-    def reset(self, total=100, desc=""):
-        self.total = total
-        self.n = 0
-        self.description = desc
-        self.progress_component.update(value=0, maximum=total, description=desc)
-        
-    def update(self, n=1):
-        self.n += n
-        if self.n > self.total:
-            self.n = self.total
-        self.progress_component.update(value=self.n)
-        
-    def set_description(self, desc):
-        self.description = desc
-        self.progress_component.update(description=desc)
+# Вкладки обработки (они же идентификаторы групп параллельного выполнения в очереди)
+STANDARD_TAB = "okpd_standard"
+FULL_FORMAT_TAB = "okpd_full_format"
+
+# Каталог, общий для всех обработок: чекпоинт кодов и кэш упрощенных названий полного формата.
+# Имя чекпоинта кодов привязано к содержимому входного файла: повторный запуск на том же файле
+# продолжает работу, а параллельные обработки разных файлов пишут в разные файлы
+CHECKPOINT_DIR = os.environ.get("OKPD_CHECKPOINT_DIR", ".okpd_checkpoints")
+
+# Количество одновременно выполняемых обработок (на вкладку) и размер очереди ожидания.
+# Все обработки используют один экземпляр модели (get_model), поэтому по умолчанию на вкладке
+# выполняется одна обработка; при достаточном объеме GPU/RAM значение можно увеличить через OKPD_CONCURRENCY
+CONCURRENCY_LIMIT = int(os.environ.get("OKPD_CONCURRENCY", 1))
+QUEUE_MAX_SIZE = 32
+# Потоки, в которых Gradio выполняет синхронные обработчики (чтение/запись Excel)
+MAX_THREADS = 64
+
+# Значение по умолчанию progress=gr.Progress() в обработчиках - это маркер: Gradio находит его
+# в сигнатуре и на каждый вызов подставляет отдельный трекер, привязанный к событию пользователя.
+# Замена на None отключила бы эту подстановку, поэтому сигнатуры оставлены в таком виде.
+
+def _stop_event_key(request, tab):
+    """Ключ флага остановки: сессия пользователя и вкладка, на которой запущена обработка"""
+    return (request.session_hash if request else None, tab)
+
+def _register_stop_event(request, tab):
+    """
+    Создает флаг остановки для новой обработки и привязывает его к сессии пользователя и вкладке
+    """
+    stop_event = threading.Event()
+    stop_events[_stop_event_key(request, tab)] = stop_event
+    return stop_event
+
+@contextmanager
+def _job_checkpoint(checkpoint_name):
+    """
+    Путь к файлу промежуточных результатов для одной обработки
     
-    def tqdm(self, iterable, desc=None, total=None):
-        if total is not None:
-            self.total = total
-        if desc is not None:
-            self.description = desc
-        
-        self.reset(total=self.total, desc=self.description)
-        
-        for item in iterable:
-            yield item
-            self.update(1)
+    Обработки выполняются параллельно, поэтому каждая пишет промежуточный xlsx в собственный
+    временный каталог под указанным пользователем именем: при остановке или ошибке
+    пользователь получает только свои промежуточные результаты. Каталог удаляется, когда
+    обработка вернула результат или была остановлена. Файлы, по которым повторный запуск
+    продолжает работу (чекпоинт кодов, кэш упрощений), хранятся в общем CHECKPOINT_DIR
+    """
+    job_dir = tempfile.mkdtemp(prefix="okpd_job_")
+    try:
+        yield os.path.join(job_dir, os.path.basename(checkpoint_name or "") or "checkpoint.xlsx")
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
 
 def process_standard_file(
     input_file,
     checkpoint_name="checkpoint.xlsx",
     save_interval=10,
-    progress=gr.Progress()
+    progress=gr.Progress(),
+    request: gr.Request = None
 ):
     """
     Обработка стандартного файла Excel с колонкой 'Наименование'
     """
     logger.info(f"Starting process with standard file: {input_file.name}")
     
-    # Сбрасываем флаг остановки при запуске новой обработки
-    stop_event.clear()
+    # Отдельный флаг остановки для этой обработки
+    stop_event = _register_stop_event(request, STANDARD_TAB)
     
     # Обновляем статус
     yield None, "Запуск обработки..."
     
-    # Создание стандартного процессора
-    processor = StandardProcessor(input_file, checkpoint_name, save_interval, progress)
-    
-    # Передаем флаг остановки в процессор
-    processor.stop_event = stop_event
-    
-    # Выполнение обработки и передача результата
-    for result in processor.process():
-        if stop_event.is_set():
-            yield None, "Обработка остановлена пользователем."
-            return
-        if result is None:
-            yield None, "Ошибка обработки. Проверьте лог для подробностей."
-        else:
-            yield result, "Обработка завершена успешно."
+    with _job_checkpoint(checkpoint_name) as job_checkpoint:
+        # Создание стандартного процессора
+        processor = StandardProcessor(input_file, job_checkpoint, save_interval, progress)
+        
+        # Передаем флаг остановки в процессор
+        processor.stop_event = stop_event
+        
+        # Выполнение обработки и передача результата
+        for result in processor.process():
+            if stop_event.is_set():
+                yield None, "Обработка остановлена пользователем."
+                return
+            if result is None:
+                yield None, "Ошибка обработки. Проверьте лог для подробностей."
+            else:
+                yield result, "Обработка завершена успешно."
 
 def process_format_41_file(
     input_file,
     checkpoint_name="checkpoint.xlsx",
     save_interval=10,
     header_rows=5,
-    progress=gr.Progress()
+    progress=gr.Progress(),
+    request: gr.Request = None
 ):
     """
     Обработка файла Excel в полном формате
     """
     logger.info(f"Starting process with Format 4_1 file: {input_file.name}")
     
-    # Сбрасываем флаг остановки при запуске новой обработки
-    stop_event.clear()
+    # Отдельный флаг остановки для этой обработки
+    stop_event = _register_stop_event(request, FULL_FORMAT_TAB)
     
     # Обновляем статус
     yield None, f"Запуск обработки файла в полном формате. Пропускаем {header_rows} строк заголовка..."
     
-    # Создание процессора для полного формата
-    processor = FullFormatProcessor(input_file, checkpoint_name, save_interval, progress)
-    
-    # Передаем флаг остановки в процессор
-    processor.stop_event = stop_event
-    
-    # Устанавливаем количество строк заголовка для пропуска
-    processor.NUM_HEADER_ROWS = int(header_rows)
-    logger.info(f"Set to skip {header_rows} header rows")
-    
-    # Выполнение обработки и передача результата с обновлением статуса
-    step = 0
-    for result in processor.process():
-        if stop_event.is_set():
-            yield None, "Обработка остановлена пользователем."
-            return
-        step += 1
-        if result is None:
-            if step == 1:
-                yield None, "Ошибка при инициализации обработки. Проверьте формат файла."
+    with _job_checkpoint(checkpoint_name) as job_checkpoint:
+        # Создание процессора для полного формата; чекпоинт кодов и кэш упрощений - в общем каталоге
+        processor = FullFormatProcessor(input_file, job_checkpoint, save_interval, progress,
+                                        cache_dir=CHECKPOINT_DIR)
+        
+        # Передаем флаг остановки в процессор
+        processor.stop_event = stop_event
+        
+        # Устанавливаем количество строк заголовка для пропуска
+        processor.NUM_HEADER_ROWS = int(header_rows)
+        logger.info(f"Set to skip {header_rows} header rows")
+        
+        # Выполнение обработки и передача результата с обновлением статуса
+        step = 0
+        for result in processor.process():
+            if stop_event.is_set():
+                yield None, "Обработка остановлена пользователем."
+                return
+            step += 1
+            if result is None:
+                if step == 1:
+                    yield None, "Ошибка при инициализации обработки. Проверьте формат файла."
+                else:
+                    yield None, "Ошибка во время обработки. Проверьте лог для подробностей."
             else:
-                yield None, "Ошибка во время обработки. Проверьте лог для подробностей."
-        else:
-            yield result, "Обработка завершена успешно."
+                yield result, "Обработка завершена успешно."
 
-def cancel_process():
+def cancel_process(tab, request: gr.Request = None):
     """
-    Отмена обработки (общая функция для всех процессоров)
+    Отмена обработки текущего пользователя на вкладке tab (общая функция для всех процессоров)
     """
-    # Устанавливаем флаг остановки
-    stop_event.set()
+    # Устанавливаем флаг остановки только для обработки этой сессии на этой вкладке
+    stop_event = stop_events.get(_stop_event_key(request, tab))
+    if stop_event is not None:
+        stop_event.set()
     
     logger.info("Stop requested by user")
     return "Обработка остановлена пользователем"
@@ -147,32 +171,39 @@ header_style = "font-size: 28px; font-weight: 600; margin-bottom: 10px"
 subheader_style = "font-size: 18px; font-weight: 500; margin-bottom: 5px"
 description_style = "font-size: 14px; margin-bottom: 20px"
 
-with gr.Blocks(
-    # theme=gr.themes.Soft(primary_hue=gr.themes.colors.green)
-    ) as demo:
-    gr.Markdown(f"<h1 style='{header_style}'>ОКПД2 Обработчик Файлов</h1>")
-    gr.Markdown(f"<p style='{description_style}'>Инструмент для автоматического присвоения кодов ОКПД2 товарам и услугам из Excel файлов.</p>")
-        
-
-    with gr.Tab("Стандартный формат"):
-        gr.Markdown(f"<h2 style='{subheader_style}'>Обработка файла с колонкой 'Наименование'</h2>")
-        gr.Markdown(f"<p style='{description_style}'>Этот режим подходит для Excel файлов, в которых есть колонка с именем 'Наименование', содержащая список товаров/услуг для классификации.</p>")
+def _build_tab(
+    title,
+    subheader,
+    description,
+    file_label,
+    checkpoint_default,
+    process_fn,
+    concurrency_id,
+    result_elem_id,
+    with_header_rows=False
+):
+    """
+    Строит вкладку обработки: загрузка файла, параметры, кнопки запуска/остановки и результат
+    """
+    with gr.Tab(title):
+        gr.Markdown(f"<h2 style='{subheader_style}'>{subheader}</h2>")
+        gr.Markdown(f"<p style='{description_style}'>{description}</p>")
         
         with gr.Row():
             with gr.Column(scale=3):
-                std_file_input = gr.File(
-                    label="Загрузить Excel файл (.xlsx)", 
+                file_input = gr.File(
+                    label=file_label, 
                     file_types=[".xlsx"],
                     interactive=True
                 )
                 
             with gr.Column(scale=2):
-                std_checkpoint_name = gr.Textbox(
+                checkpoint_name = gr.Textbox(
                     label="Имя файла для сохранения промежуточных результатов", 
-                    value="checkpoint_std.xlsx",
+                    value=checkpoint_default,
                     info="При длительной обработке файла, промежуточные результаты будут сохраняться в этот файл"
                 )
-                std_save_interval = gr.Slider(
+                save_interval = gr.Slider(
                     label="Интервал сохранения (групп)", 
                     minimum=1, 
                     maximum=50, 
@@ -180,103 +211,82 @@ with gr.Blocks(
                     step=1,
                     info="Как часто сохранять промежуточные результаты"
                 )
+                inputs = [file_input, checkpoint_name, save_interval]
+                
+                if with_header_rows:
+                    header_rows = gr.Slider(
+                        label="Количество строк заголовка", 
+                        minimum=0, 
+                        maximum=20, 
+                        value=5, 
+                        step=1,
+                        info="Пропустить указанное количество начальных строк файла (название таблицы, шапка и т.д.)"
+                    )
+                    inputs.append(header_rows)
         
         with gr.Row():
-            std_run_btn = gr.Button("Запустить обработку", variant="primary", scale=2)
-            std_stop_btn = gr.Button("Остановить", variant="stop", scale=1)
+            run_btn = gr.Button("Запустить обработку", variant="primary", scale=2)
+            stop_btn = gr.Button("Остановить", variant="stop", scale=1)
             
-        std_status = gr.Textbox(
+        status = gr.Textbox(
             label="Статус", 
             value="Готов к работе",
             interactive=False
         )
         
-        std_result_file = gr.File(
+        result_file = gr.File(
             label="Скачать результат",
             visible=True,
-            elem_id="std_result"
+            elem_id=result_elem_id
         )
 
         # Запуск обработки
-        std_run_event = std_run_btn.click(
-            fn=process_standard_file,
-            inputs=[std_file_input, std_checkpoint_name, std_save_interval],
-            outputs=[std_result_file, std_status],
-            queue=True
+        run_btn.click(
+            fn=process_fn,
+            inputs=inputs,
+            outputs=[result_file, status],
+            queue=True,
+            concurrency_id=concurrency_id
         )
         
-        # Отмена обработки
-        std_stop_btn.click(
-            fn=cancel_process,
+        # Отмена обработки, запущенной на этой вкладке
+        def cancel_tab_process(request: gr.Request = None):
+            return cancel_process(concurrency_id, request)
+        
+        stop_btn.click(
+            fn=cancel_tab_process,
             inputs=[],
-            outputs=std_status
+            outputs=status
         )
 
-    with gr.Tab("Полный формат"):
-        gr.Markdown(f"<h2 style='{subheader_style}'>Обработка файла в полном формате</h2>")
-        gr.Markdown(f"<p style='{description_style}'>Этот режим предназначен для обработки файлов в полном формате, содержащих множество колонок и пропуском служебных строк (заголовки разделов, итоги, отходы и т.д.)</p>")
-        
-        with gr.Row():
-            with gr.Column(scale=3):
-                f41_file_input = gr.File(
-                    label="Загрузить Excel файл в полном формате (.xlsx)", 
-                    file_types=[".xlsx"],
-                    interactive=True
-                )
-                
-            with gr.Column(scale=2):
-                f41_checkpoint_name = gr.Textbox(
-                    label="Имя файла для сохранения промежуточных результатов", 
-                    value="checkpoint.xlsx",
-                    info="При длительной обработке файла, промежуточные результаты будут сохраняться в этот файл"
-                )
-                f41_save_interval = gr.Slider(
-                    label="Интервал сохранения (групп)", 
-                    minimum=1, 
-                    maximum=50, 
-                    value=10, 
-                    step=1,
-                    info="Как часто сохранять промежуточные результаты"
-                )
-                f41_header_rows = gr.Slider(
-                    label="Количество строк заголовка", 
-                    minimum=0, 
-                    maximum=20, 
-                    value=5, 
-                    step=1,
-                    info="Пропустить указанное количество начальных строк файла (название таблицы, шапка и т.д.)"
-                )
-        
-        with gr.Row():
-            f41_run_btn = gr.Button("Запустить обработку", variant="primary", scale=2)
-            f41_stop_btn = gr.Button("Остановить", variant="stop", scale=1)
-        
-        f41_status = gr.Textbox(
-            label="Статус", 
-            value="Готов к работе", 
-            interactive=False
-        )
+with gr.Blocks(
+    # theme=gr.themes.Soft(primary_hue=gr.themes.colors.green)
+    ) as demo:
+    gr.Markdown(f"<h1 style='{header_style}'>ОКПД2 Обработчик Файлов</h1>")
+    gr.Markdown(f"<p style='{description_style}'>Инструмент для автоматического присвоения кодов ОКПД2 товарам и услугам из Excel файлов.</p>")
         
-        f41_result_file = gr.File(
-            label="Скачать результат",
-            visible=True,
-            elem_id="f41_result"
-        )
+    _build_tab(
+        title="Стандартный формат",
+        subheader="Обработка файла с колонкой 'Наименование'",
+        description="Этот режим подходит для Excel файлов, в которых есть колонка с именем 'Наименование', содержащая список товаров/услуг для классификации.",
+        file_label="Загрузить Excel файл (.xlsx)",
+        checkpoint_default="checkpoint_std.xlsx",
+        process_fn=process_standard_file,
+        concurrency_id=STANDARD_TAB,
+        result_elem_id="std_result"
+    )
 
-        # Запуск обработки
-        f41_run_event = f41_run_btn.click(
-            fn=process_format_41_file,
-            inputs=[f41_file_input, f41_checkpoint_name, f41_save_interval, f41_header_rows],
-            outputs=[f41_result_file, f41_status],
-            queue=True
-        )
-        
-        # Отмена обработки
-        f41_stop_btn.click(
-            fn=cancel_process,
-            inputs=[],
-            outputs=f41_status
-        )
+    _build_tab(
+        title="Полный формат",
+        subheader="Обработка файла в полном формате",
+        description="Этот режим предназначен для обработки файлов в полном формате, содержащих множество колонок и пропуском служебных строк (заголовки разделов, итоги, отходы и т.д.)",
+        file_label="Загрузить Excel файл в полном формате (.xlsx)",
+        checkpoint_default="checkpoint.xlsx",
+        process_fn=process_format_41_file,
+        concurrency_id=FULL_FORMAT_TAB,
+        result_elem_id="f41_result",
+        with_header_rows=True
+    )
 
     # Информация о программе
     with gr.Accordion("О программе", open=False):
@@ -308,7 +318,8 @@ with gr.Blocks(
         - Следите за обновлениями статуса обработки, там будет отображаться текущий этап
         """)
 
-    demo.queue()  # Включаем очередь для фоновой обработки
+    # Включаем очередь для фоновой обработки; обработки выполняются параллельно
+    demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT, max_size=QUEUE_MAX_SIZE)
 
 if __name__ == "__main__":
-    demo.launch(server_name="0.0.0.0", server_port=7860)
\ No newline at end of file
+    demo.launch(server_name="0.0.0.0", server_port=7860, max_threads=MAX_THREADS)
\ No newline at end of file
@@ -1,9 +1,17 @@
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-def setup_logger(name: str, log_file: str = 'processor.log', level: int = logging.INFO) -> logging.Logger:
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
+# Ограничение размера файла лога: хвост лога остается небольшим при длительной работе
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
 
+# Одна очередь на файл лога: вывод в консоль и запись в файл выполняет фоновый поток QueueListener,
+# а вызывающий код только кладет запись в очередь. Ротацию выполняет единственный файловый обработчик.
+_queue_handlers = {}
+
+def _create_queue_handler(log_file: str) -> QueueHandler:
     fmt = logging.Formatter(
         '%(asctime)s [%(levelname)s] %(name)s: %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
@@ -12,11 +20,31 @@ def setup_logger(name: str, log_file: str = 'processor.log', level: int = loggin
     # Console handler
     ch = logging.StreamHandler()
     ch.setFormatter(fmt)
-    logger.addHandler(ch)
 
     # File handler
-    fh = logging.FileHandler(log_file, encoding='utf-8')
+    fh = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
     fh.setFormatter(fmt)
-    logger.addHandler(fh)
 
-    return logger
\ No newline at end of file
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, ch, fh, respect_handler_level=True)
+    listener.start()
+    # Дописываем оставшиеся в очереди записи при завершении процесса
+    atexit.register(listener.stop)
+
+    qh = QueueHandler(log_queue)
+    qh.listener = listener
+    return qh
+
+def setup_logger(name: str, log_file: str = 'processor.log', level: int = logging.INFO) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+
+    qh = _queue_handlers.get(log_file)
+    if qh is None:
+        qh = _create_queue_handler(log_file)
+        _queue_handlers[log_file] = qh
+
+    # Повторный вызов для того же логгера не добавляет обработчик второй раз
+    logger.addHandler(qh)
+
+    return logger
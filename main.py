@@ -1,12 +1,17 @@
+import numpy as np
 import pandas as pd
+import string
+import unicodedata
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 from tqdm import tqdm
 import time
 import logging
 
 from logger import setup_logger
-from src.model import Model
+from src.model import get_model
+from src.excel_io import PANDAS_EXCEL_ENGINE, PANDAS_WRITER_ENGINE, PANDAS_WRITER_KWARGS, write_dataframe
 from src.utils import extract_code, remove_links
 from src.morphology import normalize_term
 from src.web_search import web_search
@@ -14,8 +19,23 @@ from src.okpd_fetch import fetch_okpd2_batch
 
 logger = setup_logger(__name__)
 
+# Number of simplification prompts generated in parallel
+SIMPLIFY_WORKERS = 4
+# Number of web searches for decision context run in parallel (kept low to respect rate limits)
+WEB_SEARCH_WORKERS = 2
+# Columns the decisions are written to
+RESULT_COLUMNS = ['ОКПД код','Название кода','Комментарий']
+# Minimum wall-clock time between two checkpoint writes
+CHECKPOINT_MIN_SECONDS = 30
+# Decision for a term without OKPD candidates
+DEFAULT_DECISION = ('32.99.59.000', 'Изделия различные прочие, не включенные в другие группировки', '')
+
+def _group_key(word: str) -> str:
+    """Canonical form of a grouping word: NFKC, no surrounding punctuation, casefolded"""
+    return unicodedata.normalize('NFKC', word).strip(string.punctuation + '«»“”„').casefold()
+
 def group_similar(elements: List[str]) -> List[List[str]]:
-    """Group similar items by their first word"""
+    """Group similar items by their first word (case and punctuation insensitive)"""
     by_key = defaultdict(list)
     for el in elements:
         if not el or not isinstance(el, str):
@@ -23,26 +43,30 @@ def group_similar(elements: List[str]) -> List[List[str]]:
         words = el.split()
         if not words:
             continue
-        key = words[0]
+        key = _group_key(words[0]) or words[0]
         by_key[key].append(el)
     return list(by_key.values())
 
 class Processor:
     def __init__(self, input_excel: str, output_excel: str, checkpoint: str = 'checkpoint.xlsx', save_interval: int = 10):
         try:
-            self.df = pd.read_excel(input_excel)
+            self.df = pd.read_excel(input_excel, engine=PANDAS_EXCEL_ENGINE)
             if 'Наименование' not in self.df.columns:
                 logger.error(f"Input file {input_excel} doesn't have a 'Наименование' column")
                 raise ValueError(f"Input file {input_excel} doesn't have a 'Наименование' column")
                 
             self.terms = self.df['Наименование'].dropna().tolist()
             
-            self.model = Model()
+            self.model = get_model()
             
             # Initialize result columns
-            for col in ['ОКПД код','Название кода','Комментарий']:
+            for col in RESULT_COLUMNS:
                 if col not in self.df.columns:
                     self.df[col] = ''
+
+            # Row positions of every distinct name, built once in a single groupby pass
+            self._row_index = self.df.groupby('Наименование', sort=False).indices
+            self._result_positions = [self.df.columns.get_loc(col) for col in RESULT_COLUMNS]
                 
             self.checkpoint = checkpoint
             self.save_interval = save_interval
@@ -55,6 +79,7 @@ class Processor:
             raise
 
     def run(self):
+        results = {}  # term -> (code, name, comment), written to self.df in one pass
         try:
             logger.info("Starting processing pipeline")
             
@@ -70,78 +95,162 @@ class Processor:
             simplified = []
             
             logger.info("Simplifying terms...")
-            for norm in normalized:
-                try:
-                    prompt = [{"role": "user", "content": norm}]
-                    resp = self.model.generate(prompt)
-                    simplified.append(resp['content'])
-                except Exception as e:
-                    logger.error(f"Error simplifying term '{norm}': {e}")
+            prompts = [[{"role": "user", "content": norm}] for norm in normalized]
+            responses = self.model.generate_many(prompts, workers=SIMPLIFY_WORKERS)
+            for norm, resp in zip(normalized, responses):
+                if resp is None:
+                    logger.error(f"Error simplifying term '{norm}'")
                     simplified.append(norm)  # Use normalized as fallback
+                else:
+                    simplified.append(resp['content'])
 
-            # Fetch OKPD data in batch
+            # Fetch OKPD data in batch, once per distinct simplified term
             logger.info("Fetching OKPD data...")
-            okpd_data = fetch_okpd2_batch(simplified)
+            okpd_data = fetch_okpd2_batch(list(dict.fromkeys(simplified)))
+
+            # Search web context for every distinct representative that has OKPD candidates in the
+            # background; each group waits only for its own search, so searches overlap with decisions
+            logger.info("Prefetching decision context...")
+            context_executor = ThreadPoolExecutor(max_workers=WEB_SEARCH_WORKERS)
+            try:
+                contexts = self._prefetch_contexts(
+                    context_executor,
+                    (rep for rep, simp in zip(reps, simplified) if okpd_data.get(simp))
+                )
 
-            # Process each group
-            logger.info("Processing groups and assigning codes...")
-            for idx, grp in enumerate(tqdm(groups, desc='Processing')):
-                if not grp:
-                    continue
+                # Process each group
+                logger.info("Processing groups and assigning codes...")
+                last_checkpoint = time.monotonic()
+                for idx, grp in enumerate(tqdm(groups, desc='Processing')):
+                    if not grp:
+                        continue
                     
-                rep, simp = reps[idx], simplified[idx]
-                entries = okpd_data.get(simp, [])
+                    rep, simp = reps[idx], simplified[idx]
+                    entries = okpd_data.get(simp, [])
                 
-                try:
-                    code, name, comment = self._decide(entries, rep, simp)
-                    mask = self.df['Наименование'].isin(grp)
-                    self.df.loc[mask, ['ОКПД код','Название кода','Комментарий']] = [code, name, comment]
-                except Exception as e:
-                    logger.error(f"Error processing group {idx} ({rep}): {e}")
-
-                # Save checkpoint at intervals
-                if (idx+1) % self.save_interval == 0:
-                    self.df.to_excel(self.checkpoint, index=False)
-                    logger.info(f"Saved checkpoint at group {idx+1}/{len(groups)}")
+                    try:
+                        code, name, comment = self._decide(entries, rep, simp, context=self._context_result(contexts.get(rep)))
+                        for term in grp:
+                            results[term] = (code, name, comment)
+                    except Exception as e:
+                        logger.error(f"Error processing group {idx} ({rep}): {e}")
+
+                    # Save checkpoint at intervals, but not more often than CHECKPOINT_MIN_SECONDS
+                    if (idx+1) % self.save_interval == 0 and time.monotonic() - last_checkpoint >= CHECKPOINT_MIN_SECONDS:
+                        self._apply_results(results)
+                        write_dataframe(self.df, self.checkpoint)
+                        last_checkpoint = time.monotonic()
+                        logger.info("Saved checkpoint at group %d/%d", idx+1, len(groups))
+            finally:
+                context_executor.shutdown(cancel_futures=True)
 
             # Save final result
-            self.df.to_excel(self.output_excel, index=False)
+            self._apply_results(results)
+            with pd.ExcelWriter(self.output_excel, engine=PANDAS_WRITER_ENGINE, engine_kwargs=PANDAS_WRITER_KWARGS) as writer:
+                self.df.to_excel(writer, index=False)
             logger.info(f"Saved to {self.output_excel}")
             
         except Exception as e:
             logger.error(f"Error in processor run: {e}")
             # Try to save what we have
             try:
-                self.df.to_excel(self.checkpoint, index=False)
+                self._apply_results(results)
+                write_dataframe(self.df, self.checkpoint)
                 logger.info(f"Saved emergency checkpoint due to error")
             except:
                 pass
             raise
 
-    def _decide(self, entries, original, simplified):
-        """Decide which OKPD code to use for a given term"""
-        if not entries:
-            return '32.99.59.000', 'Изделия различные прочие, не включенные в другие группировки', ''
+    def _apply_results(self, results):
+        """Write accumulated decisions into the result columns with one positional assignment"""
+        rows = []
+        decisions = []
+        for term, values in results.items():
+            term_rows = self._row_index.get(term)
+            if term_rows is None:
+                continue
+            rows.extend(term_rows)
+            decisions.extend([values] * len(term_rows))
+        if not rows:
+            return
+        self.df.iloc[rows, self._result_positions] = np.array(decisions, dtype=object)
 
-        options = '\n'.join(f"{e['code']} — {e['name']}" for e in entries)
-        
+    @staticmethod
+    def _search_context(original):
+        """Web search context for a term, with the generic fallback on failure"""
         try:
             raw = web_search(original)
-            context = remove_links(' '.join(raw))
+            return remove_links(' '.join(raw))
         except Exception as e:
             logger.warning(f"Web search failed for {original}: {e}")
-            context = f"Информация о '{original}' для промышленного применения"
+            return f"Информация о '{original}' для промышленного применения"
+
+    def _prefetch_contexts(self, executor, originals):
+        """Submit a context search for each distinct term to executor; returns term -> Future"""
+        return {original: executor.submit(self._search_context, original) for original in dict.fromkeys(originals)}
+
+    @staticmethod
+    def _context_result(future):
+        """Context from a prefetch future; None (search again in _decide) if it is missing or failed"""
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.warning(f"Context prefetch failed: {e}")
+            return None
+
+    def _decide(self, entries, original, simplified, context=None):
+        """Decide which OKPD code to use for a given term"""
+        if not entries:
+            return DEFAULT_DECISION
+
+        if context is None:
+            context = Processor._search_context(original)
+
+        resp = self.model.generate(Processor._decide_prompt(entries, simplified, context))
+        return Processor._pick_code(entries, resp['content'])
 
-        prompt = [
+    def _decide_many(self, requests):
+        """
+        Decide OKPD codes for several terms with one batched model call.
+
+        requests is a list of (entries, original, simplified, context) tuples; the decision
+        prompts of all terms that have candidates go to model.generate_many together.
+        Returns (code, name, comment) per request, in order, or None where generation failed.
+        """
+        decisions = [DEFAULT_DECISION] * len(requests)
+        pending = []  # (request position, prompt)
+        for pos, (entries, original, simplified, context) in enumerate(requests):
+            if not entries:
+                continue
+            if context is None:
+                context = Processor._search_context(original)
+            pending.append((pos, Processor._decide_prompt(entries, simplified, context)))
+
+        if pending:
+            responses = self.model.generate_many([prompt for _, prompt in pending], workers=SIMPLIFY_WORKERS)
+            for (pos, _), resp in zip(pending, responses):
+                decisions[pos] = None if resp is None else Processor._pick_code(requests[pos][0], resp['content'])
+        return decisions
+
+    @staticmethod
+    def _decide_prompt(entries, simplified, context):
+        """Prompt asking the model to choose one of the candidate codes"""
+        options = '\n'.join(f"{e['code']} — {e['name']}" for e in entries)
+
+        return [
             {"role": "system", "content": 'Ты помогаешь выбрать один код для военной компании, которая занимается производством и работает с различным металом.'},
             {"role": "user", "content": f"Ты составляешь таблицу закупок товаров для военной компании, которая занимается производством и работает с различным металом. \
             Твоя задача выбрать подходящий код для товара отталкиваясь от специфики военного предприятия, где используются различные ЧЕРНЫЕ МЕТАЛЫ, АЛЮМИНИЙ.\n\
             #Тебе ЗАПРЕЩЕНО указывать коды: медицина, Мебель медицинская, гипс. \n \
             \nТовар: {simplified}\nКонтекст: {context}\nВарианты:\n{options}\nВыведи только код:"}
         ]
-        
-        resp = self.model.generate(prompt)
-        code = extract_code(resp['content'])
+
+    @staticmethod
+    def _pick_code(entries, content):
+        """Map the model answer to one of the candidate entries"""
+        code = extract_code(content)
         
         # Find name for the selected code
         name = ''
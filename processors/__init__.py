@@ -2,14 +2,26 @@
 Модуль обработчиков различных форматов Excel-файлов для ОКПД
 """
 
-from .base_processor import BaseProcessor
-from .standard_processor import StandardProcessor
-from .full_format_processor import FullFormatProcessor
-from .multi_sheet_processor import MultiSheetProcessor
-
-__all__ = [
-    'BaseProcessor',
-    'StandardProcessor', 
-    'FullFormatProcessor', 
-    'MultiSheetProcessor'
-] 
\ No newline at end of file
+import importlib
+
+# Классы загружаются при первом обращении (PEP 562): импорт одного обработчика,
+# например processors.standard_processor, не тянет за собой модули остальных
+_LAZY_IMPORTS = {
+    'BaseProcessor': '.base_processor',
+    'StandardProcessor': '.standard_processor',
+    'FullFormatProcessor': '.full_format_processor',
+    'MultiSheetProcessor': '.multi_sheet_processor',
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+def __getattr__(name):
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_LAZY_IMPORTS[name], __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
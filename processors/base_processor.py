@@ -2,15 +2,17 @@
 Базовый класс процессора, определяющий общий интерфейс для всех обработчиков файлов
 """
 
+import hashlib
+import io
 import os
 import tempfile
-import pandas as pd
 import threading
 import logging
 import time
 from abc import ABC, abstractmethod
 import gradio as gr
-from src.model import Model
+from src.model import get_model
+from src.excel_io import write_dataframe
 from logger import setup_logger
 
 class BaseProcessor(ABC):
@@ -33,6 +35,10 @@ class BaseProcessor(ABC):
         self.model = None
         self.df = None
         
+        # Содержимое входного файла, прочитанное один раз для всех читателей (openpyxl, pandas)
+        self._input_bytes = None
+        self._input_hash = None
+        
         # Добавляем метки времени для отслеживания прогресса
         self.start_time = None
         self.end_time = None
@@ -42,7 +48,7 @@ class BaseProcessor(ABC):
         try:
             self.logger.info("Инициализация модели...")
             start_time = time.time()
-            self.model = Model()
+            self.model = get_model()
             elapsed = time.time() - start_time
             self.logger.info(f"Модель инициализирована успешно за {elapsed:.1f} сек.")
             return True
@@ -50,6 +56,30 @@ class BaseProcessor(ABC):
             self.logger.exception(f"Ошибка инициализации модели: {e}")
             return False
     
+    def _input_stream(self):
+        """
+        Возвращает новый поток BytesIO с содержимым входного файла.
+        
+        Файл читается с диска один раз; каждый вызов получает собственный поток
+        с позицией в начале, поэтому повторные чтения не обращаются к диску.
+        """
+        if self._input_bytes is None:
+            with open(self.input_path, 'rb') as f:
+                self._input_bytes = f.read()
+        return io.BytesIO(self._input_bytes)
+    
+    def _input_digest(self):
+        """Хэш содержимого входного файла (для кэшей, привязанных к конкретному файлу)"""
+        if self._input_hash is None:
+            self._input_stream()
+            self._input_hash = hashlib.blake2b(self._input_bytes, digest_size=16).hexdigest()
+        return self._input_hash
+    
+    def _invalidate_input_stream(self):
+        """Сбрасывает прочитанное содержимое после перезаписи входного файла"""
+        self._input_bytes = None
+        self._input_hash = None
+    
     def cancel(self):
         """Отменить обработку"""
         self.stop_event.set()
@@ -62,19 +92,10 @@ class BaseProcessor(ABC):
             if hasattr(self, 'df') and self.df is not None:
                 self.logger.info(f"Сохранение промежуточного результата в {self.checkpoint_name}...")
                 
-                # Проверяем, существует ли файл чекпоинта
-                file_exists = os.path.exists(self.checkpoint_name)
-                
                 try:
-                    if file_exists:
-                        # Если файл существует, записываем в него
-                        with pd.ExcelWriter(self.checkpoint_name, engine='openpyxl', mode='a', 
-                                        if_sheet_exists='replace') as writer:
-                            self.df.to_excel(writer, sheet_name=sheet_name, index=False)
-                    else:
-                        # Если файл не существует, создаем новый
-                        with pd.ExcelWriter(self.checkpoint_name, engine='openpyxl', mode='w') as writer:
-                            self.df.to_excel(writer, sheet_name=sheet_name, index=False)
+                    # Файл чекпоинта каждый раз пишется заново потоковой записью,
+                    # без разбора предыдущей версии (как было бы в режиме ExcelWriter mode='a')
+                    write_dataframe(self.df, self.checkpoint_name, sheet_name=sheet_name)
                     
                     if idx and total:
                         self.logger.info(f"Сохранен промежуточный результат {idx}/{total}")
@@ -154,6 +175,9 @@ class BaseProcessor(ABC):
             else:
                 self.logger.error("Промежуточный файл не найден")
                 yield None
+        finally:
+            # Трекер прогресса принадлежит запросу Gradio; после обработки процессор его не удерживает
+            self.progress = None
     
     @abstractmethod
     def _process_file(self):
@@ -3,18 +3,124 @@
 """
 
 import pandas as pd
+import numpy as np
+import json
+import logging
 import os
 import re
 import openpyxl
 import shutil
+import threading
 import time
-from copy import copy
-from main import Processor, group_similar
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from main import Processor, SIMPLIFY_WORKERS, WEB_SEARCH_WORKERS, group_similar
 from src.morphology import normalize_term
-from src.okpd_fetch import fetch_okpd2_batch
+from src.okpd_fetch import fetch_okpd2_batch, okpd2_session
+from src.excel_io import PANDAS_EXCEL_ENGINE, header_tokens, read_header_rows, save_workbook
 from openpyxl.utils import get_column_letter
 from .base_processor import BaseProcessor
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    from rapidfuzz import fuzz, process as fuzz_process
+except ImportError:
+    fuzz = None
+
+# Кэш найденных колонок: (хэш файла, лист, строк заголовка) -> (наименование, код, строка заголовка кода, время)
+_COLUMNS_CACHE = {}
+COLUMNS_CACHE_TTL = 30 * 60  # секунд
+# Кэш общий для обработок, выполняемых параллельно в потоках Gradio
+_COLUMNS_CACHE_LOCK = threading.Lock()
+# Количество групп, для которых упрощение и запрос кодов ОКПД выполняются одним пакетом
+GROUP_BATCH_SIZE = 16
+
+# Символы, которые могут различаться в одинаковых наименованиях, заменяются пробелами одним проходом
+_SEPARATORS_TABLE = str.maketrans({'-': ' ', '_': ' ', '.': ' ', ',': ' '})
+# Непечатаемые символы, которые встречаются в ячейках чаще всего: управляющие символы C0/C1,
+# мягкий перенос, символы нулевой ширины и направления текста, BOM
+_CONTROL_CHARS_RE = re.compile('[\x00-\x1f\x7f-\x9f\xad\u200b-\u200f\u202a-\u202e\u2060-\u2064\ufeff]')
+
+@lru_cache(maxsize=200_000)
+def _normalize_cell_text(text):
+    """Нормализует текст ячейки для сравнения (результат кэшируется: тексты ячеек часто повторяются)"""
+    if not text:
+        return ""
+        
+    # Убираем лишние пробелы (split учитывает и неразрывные пробелы)
+    text = " ".join(str(text).split())
+    
+    # Удаляем непечатаемые символы; посимвольный проход нужен только для редких символов вне шаблона
+    if not text.isprintable():
+        text = _CONTROL_CHARS_RE.sub('', text)
+        if not text.isprintable():
+            text = ''.join(c for c in text if c.isprintable())
+    
+    # Игнорируем специальные символы, которые могут различаться
+    text = " ".join(text.translate(_SEPARATORS_TABLE).split())
+    
+    return text.lower()  # Приводим к нижнему регистру для регистронезависимого сравнения
+
+def _split_skip_patterns(patterns):
+    """
+    Делит шаблоны служебных строк на целые слова и остальные выражения.
+    
+    Шаблон вида \\bСлово\\b (в том числе с необязательным продолжением \\bСлово(\\s+слово)?\\b)
+    совпадает ровно тогда, когда в тексте есть это слово целиком, поэтому его можно искать без regex.
+    
+    Returns:
+        tuple: (список слов в нижнем регистре, список остальных шаблонов)
+    """
+    keywords, rest = [], []
+    for pattern in patterns:
+        match = re.fullmatch(r'\\b(\w+)(?:\(\\s\+\w+\)\?)?\\b', pattern)
+        if match:
+            keywords.append(match.group(1).lower())
+        else:
+            rest.append(pattern)
+    return keywords, rest
+
+def _non_capturing(pattern):
+    """Заменяет захватывающие группы шаблона на незахватывающие"""
+    return re.sub(r'(?<!\\)\((?!\?)', '(?:', pattern)
+
+def _is_word_char(char):
+    """Символ слова в смысле \\w регулярных выражений"""
+    return char.isalnum() or char == '_'
+
+def _bigrams(text):
+    """Множество пар соседних символов строки"""
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def _containment_shortlist(query, bigram_index, bigram_counts):
+    """
+    Индексы строк, которые могут содержать query или содержаться в нем (по инвертированному индексу биграмм).
+    
+    Строка, содержащая запрос, содержит все его биграммы; строка, входящая в запрос, состоит
+    только из биграмм запроса. Совпадение подстроки после этого отбора нужно проверить.
+    
+    Args:
+        bigram_index: Словарь {биграмма: множество индексов строк}; строки короче двух символов
+            хранятся под пустой биграммой и проверяются всегда
+        bigram_counts: Количество различных биграмм каждой строки
+    """
+    query_bigrams = _bigrams(query)
+    if not query_bigrams:
+        return set(range(len(bigram_counts)))
+    
+    shortlist = set(bigram_index.get('', ()))
+    
+    postings = [bigram_index.get(bigram, set()) for bigram in query_bigrams]
+    shortlist.update(set.intersection(*postings))
+    hits = Counter(index for posting in postings for index in posting)
+    shortlist.update(index for index, count in hits.items() if count == bigram_counts[index])
+    return shortlist
+
 class FullFormatProcessor(BaseProcessor):
     """
     Процессор для формата 4_1.
@@ -65,10 +171,51 @@ class FullFormatProcessor(BaseProcessor):
         r'\bШт\b$'
     ]
     
-    # Компилируем регулярные выражения для быстрой проверки
-    SKIP_PATTERNS_COMPILED = [re.compile(pattern, re.IGNORECASE) for pattern in SKIP_PATTERNS]
+    # Все шаблоны одним выражением для проверки целой колонки за один проход
+    # (без захватывающих групп: str.contains предупреждает о них)
+    SKIP_PATTERN_COMBINED = re.compile('|'.join(f'(?:{_non_capturing(pattern)})' for pattern in SKIP_PATTERNS), re.IGNORECASE)
+    # То же выражение с именованными группами p0..pN: m.lastgroup указывает сработавший шаблон
+    SKIP_PATTERN_INDEXED = re.compile('|'.join(f'(?P<p{i}>{pattern})' for i, pattern in enumerate(SKIP_PATTERNS)), re.IGNORECASE)
+    
+    # Для проверки колонки целиком: слова ищутся одним автоматом Ахо-Корасик (если установлен
+    # pyahocorasick), остальные шаблоны - одним выражением меньшего размера
+    SKIP_KEYWORDS, SKIP_REGEX_PATTERNS = _split_skip_patterns(SKIP_PATTERNS)
+    SKIP_PATTERN_REST = re.compile('|'.join(f'(?:{pattern})' for pattern in SKIP_REGEX_PATTERNS), re.IGNORECASE)
+    if ahocorasick is not None:
+        SKIP_KEYWORDS_AUTOMATON = ahocorasick.Automaton()
+        for keyword in SKIP_KEYWORDS:
+            SKIP_KEYWORDS_AUTOMATON.add_word(keyword, keyword)
+        SKIP_KEYWORDS_AUTOMATON.make_automaton()
+    else:
+        SKIP_KEYWORDS_AUTOMATON = None
+    
+    @classmethod
+    def _is_service_text(cls, text):
+        """Проверяет текст по всем шаблонам служебных строк (то же, что SKIP_PATTERN_COMBINED)"""
+        lowered = text.lower()
+        for end, keyword in cls.SKIP_KEYWORDS_AUTOMATON.iter(lowered):
+            start = end - len(keyword) + 1
+            # Совпадение засчитывается только для целого слова, как \b в шаблоне
+            if (start == 0 or not _is_word_char(lowered[start - 1])) and \
+                    (end + 1 == len(lowered) or not _is_word_char(lowered[end + 1])):
+                return True
+        return cls.SKIP_PATTERN_REST.search(text) is not None
+    
+    @classmethod
+    def _service_mask(cls, texts):
+        """Булева маска служебных строк для Series с текстами"""
+        if cls.SKIP_KEYWORDS_AUTOMATON is None:
+            return texts.str.contains(cls.SKIP_PATTERN_COMBINED)
+        return texts.map(cls._is_service_text).astype(bool)
     
-    def __init__(self, input_file=None, checkpoint_name="checkpoint.xlsx", save_interval=10, progress=None):
+    @classmethod
+    def _match_skip_pattern(cls, text):
+        """Возвращает номер шаблона служебной строки, которому соответствует текст, или None"""
+        match = cls.SKIP_PATTERN_INDEXED.search(text)
+        return int(match.lastgroup[1:]) if match else None
+    
+    def __init__(self, input_file=None, checkpoint_name="checkpoint.xlsx", save_interval=10, progress=None,
+                 preserve_formatting=True, cache_dir=None):
         super().__init__(input_file, checkpoint_name, save_interval, progress)
         # Инициализируем напрямую без использования свойства
         self._num_header_rows = self._DEFAULT_HEADER_ROWS
@@ -82,12 +229,29 @@ class FullFormatProcessor(BaseProcessor):
             
         # Коды ОКПД для обновления в файле
         self.results_to_update = {}
+        # Каталог чекпоинта кодов и кэша упрощений (по умолчанию - каталог файла чекпоинта);
+        # должен сохраняться между запусками, чтобы повторный запуск продолжил работу
+        self.cache_dir = cache_dir
+        # Файл с порциями найденных кодов (JSON Lines), привязанный к содержимому входного файла
+        self._codes_checkpoint_path = None
+        # Упрощенные моделью названия: нормализованный текст -> упрощенный термин.
+        # Хранится в каталоге cache_dir и используется повторными запусками на любых файлах
+        self._simplify_cache = {}
+        self._simplify_cache_path = None
+        self._simplify_cache_dirty = False
         
         # Данные о файле
-        self.workbook = None
+        self.workbook = None  # Изменяемая книга, открывается только для записи кодов
+        self._ro_workbook = None  # Книга в режиме только для чтения для анализа листов
+        self._excel_file = None  # pandas.ExcelFile, открытый на время сбора элементов
         self.sheet_name = None
         self.name_column_index = None
         self.code_column_index = None
+        self.code_header_row = None
+        
+        # Сохранять ли форматирование исходного файла. Без него результат пишется потоком
+        # в новую книгу (write_only): быстрее и без загрузки стилей в память
+        self.preserve_formatting = preserve_formatting
     
     # Свойство для доступа к атрибуту _num_header_rows экземпляра
     @property
@@ -121,52 +285,106 @@ class FullFormatProcessor(BaseProcessor):
         
     def _find_columns_in_excel(self):
         """
-        Находит колонки с наименованием и кодами ОКПД в файле Excel
-        непосредственно используя openpyxl
+        Находит колонки с наименованием и кодами ОКПД в файле Excel.
+        
+        Результат запоминается по содержимому файла, листу и числу строк заголовка,
+        поэтому повторный запуск на том же файле не анализирует лист заново.
         """
         if not self.input_path or not os.path.exists(self.input_path):
             self.logger.error("Не указан путь к входному файлу")
             return False
-            
+        
+        cache_key = None
+        if self.sheet_name:
+            cache_key = (self._input_digest(), self.sheet_name, self._num_header_rows)
+            with _COLUMNS_CACHE_LOCK:
+                cached = _COLUMNS_CACHE.get(cache_key)
+            if cached and time.monotonic() - cached[3] < COLUMNS_CACHE_TTL:
+                self.name_column_index, self.code_column_index, self.code_header_row, _ = cached
+                self.logger.info(f"Колонки листа '{self.sheet_name}' взяты из кэша: наименование({self.name_column_index}), код({self.code_column_index})")
+                return True
+        
+        if not self._detect_columns():
+            return False
+        
+        if cache_key:
+            now = time.monotonic()
+            with _COLUMNS_CACHE_LOCK:
+                for key in [k for k, v in _COLUMNS_CACHE.items() if now - v[3] >= COLUMNS_CACHE_TTL]:
+                    del _COLUMNS_CACHE[key]
+                _COLUMNS_CACHE[cache_key] = (self.name_column_index, self.code_column_index, self.code_header_row, now)
+        return True
+    
+    def _detect_columns(self):
+        """
+        Анализирует заголовок листа self.sheet_name и определяет колонки с наименованием
+        и кодами ОКПД.
+        
+        Первые строки листа читаются из открытого pandas.ExcelFile (при сборе элементов),
+        иначе - через openpyxl в режиме только для чтения
+        """
         try:
-            # Открываем Excel файл
-            if not self.workbook:
-                self.workbook = openpyxl.load_workbook(self.input_path)
-            self.logger.info(f"Excel файл открыт: {self.input_path}")
+            # Заголовки ищутся в первых 15 строках и 19 колонках. Тем же чтением берутся
+            # первые строки данных (до 9 после заголовка) и еще 4 колонки для поиска пустой колонки под коды
+            max_row = max(15, self._num_header_rows + 9)
+            max_col = 19 + 4
             
-            # Определяем нужный лист на основе self.sheet_name
-            if self.sheet_name and self.sheet_name in self.workbook.sheetnames:
-                sheet = self.workbook[self.sheet_name]
+            if self._excel_file is not None:
+                sheet_names = self._excel_file.sheet_names
+                if not self.sheet_name or self.sheet_name not in sheet_names:
+                    self.sheet_name = sheet_names[0]
+                sheet_title = self.sheet_name
+                
+                head = self._excel_file.parse(sheet_title, header=None, nrows=max_row)
+                max_column = head.shape[1] or 20
+                head = head.iloc[:, :max_col].astype(object)
+                header_rows = list(head.where(head.notna(), None).itertuples(index=False, name=None))
             else:
-                # Используем активный лист, если sheet_name не задан или не найден
-                sheet = self.workbook.active
-                self.sheet_name = sheet.title
+                # Открываем Excel файл в потоковом режиме: нам нужны только значения ячеек
+                if not self._ro_workbook:
+                    self._ro_workbook = openpyxl.load_workbook(self._input_stream(), read_only=True, data_only=True)
+                    self.logger.info(f"Excel файл открыт: {self.input_path}")
+                workbook = self._ro_workbook
+                
+                # Определяем нужный лист на основе self.sheet_name
+                if self.sheet_name and self.sheet_name in workbook.sheetnames:
+                    sheet = workbook[self.sheet_name]
+                else:
+                    # Используем активный лист, если sheet_name не задан или не найден
+                    sheet = workbook.active
+                    self.sheet_name = sheet.title
+                sheet_title = sheet.title
+                
+                header_rows = read_header_rows(workbook, sheet_title, max_row=max_row, max_col=max_col)
+                # Размер листа из тега <dimension> ненадежен: ширина - до последней непустой ячейки прочитанных строк
+                max_column = max(
+                    (idx + 1 for values in header_rows for idx, value in enumerate(values) if value is not None),
+                    default=0
+                ) or 20
             
-            self.logger.info(f"Анализируем лист: {sheet.title}")
+            self.logger.info(f"Анализируем лист: {sheet_title}")
             
             # Ищем в первых нескольких строках заголовки колонок
             name_column = None
             code_column = None
+            self.code_header_row = None
             
-            # Проверяем первые 15 строк (обычно заголовки там)
-            max_check_row = min(15, sheet.max_row)
-            
-            for row in range(1, max_check_row + 1):
-                for col in range(1, min(20, sheet.max_column + 1)):
-                    cell_value = sheet.cell(row=row, column=col).value
-                    
+            for row, values in enumerate(header_rows[:15], start=1):
+                for col, cell_value in enumerate(values[:19], start=1):
                     if not cell_value:
                         continue
                         
-                    cell_text = str(cell_value).strip().lower()
+                    tokens = header_tokens(str(cell_value).strip().lower())
+                    if not tokens:
+                        continue
                     
                     # Ищем колонку с наименованием
-                    if cell_text == "наименование" or "наименов" in cell_text:
+                    if "наименов" in tokens:
                         name_column = col
                         self.logger.info(f"Найдена колонка 'Наименование': строка {row}, колонка {col}")
                     
                     # Ищем колонку с кодом ОКПД
-                    if "код" in cell_text and ("окп" in cell_text or "окпд" in cell_text):
+                    if "код" in tokens and "окп" in tokens:
                         code_column = col
                         self.logger.info(f"Найдена колонка 'Код ОКП/ОКПД2': строка {row}, колонка {col}")
                     
@@ -180,35 +398,154 @@ class FullFormatProcessor(BaseProcessor):
             if name_column and not code_column:
                 self.name_column_index = name_column
                 # Ищем первую пустую колонку после наименования для кодов ОКПД
-                for col in range(name_column + 1, min(name_column + 5, sheet.max_column + 1)):
-                    is_empty = True
-                    for row in range(self._num_header_rows + 1, min(self._num_header_rows + 10, sheet.max_row + 1)):
-                        if sheet.cell(row=row, column=col).value:
-                            is_empty = False
-                            break
+                last_col = min(name_column + 4, max_column)
+                data_rows = header_rows[self._num_header_rows:self._num_header_rows + 9]
+                
+                for col in range(name_column + 1, last_col + 1):
+                    is_empty = not any(col <= len(values) and values[col - 1] for values in data_rows)
                     
                     if is_empty:
                         code_column = col
                         self.code_column_index = col
                         self.logger.info(f"Не найдена колонка для кодов ОКПД, будем использовать колонку {col}")
                         
-                        # Добавляем заголовок в ячейку для кодов ОКПД
-                        header_row = self._num_header_rows
-                        for row in range(1, header_row + 1):
-                            if sheet.cell(row=row, column=name_column).value:
-                                sheet.cell(row=row, column=col).value = "Код ОКП/ОКПД2"
-                                self.logger.info(f"Добавлен заголовок 'Код ОКП/ОКПД2' в строку {row}, колонку {col}")
+                        # Запоминаем строку, в которую нужно добавить заголовок для кодов ОКПД;
+                        # сама запись выполняется в изменяемой книге перед сохранением
+                        for row, values in enumerate(header_rows[:self._num_header_rows], start=1):
+                            if name_column <= len(values) and values[name_column - 1]:
+                                self.code_header_row = row
                                 break
                         return True
             
             # Не нашли нужные колонки
-            self.logger.error(f"Не удалось найти колонки 'Наименование' и 'Код ОКП/ОКПД2' на листе {sheet.title}")
+            self.logger.error(f"Не удалось найти колонки 'Наименование' и 'Код ОКП/ОКПД2' на листе {sheet_title}")
             return False
             
         except Exception as e:
             self.logger.exception(f"Ошибка при анализе Excel файла: {e}")
             return False
     
+    def _write_code_header(self, sheet):
+        """Добавляет заголовок 'Код ОКП/ОКПД2' в найденную колонку, если его не было в файле"""
+        if not self.code_header_row or not self.code_column_index:
+            return
+        sheet.cell(row=self.code_header_row, column=self.code_column_index).value = "Код ОКП/ОКПД2"
+        self.logger.info(f"Добавлен заголовок 'Код ОКП/ОКПД2' в строку {self.code_header_row}, колонку {self.code_column_index}")
+    
+    def _close_read_only_workbook(self):
+        """Закрывает книгу, открытую в режиме только для чтения"""
+        if self._ro_workbook:
+            self._ro_workbook.close()
+            self._ro_workbook = None
+    
+    def _cache_base_name(self):
+        """Путь без расширения для файлов, переживающих запуск: имя чекпоинта в каталоге cache_dir"""
+        base_name = os.path.splitext(self.checkpoint_name)[0]
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            base_name = os.path.join(self.cache_dir, os.path.basename(base_name))
+        return base_name
+    
+    def _load_codes_checkpoint(self):
+        """
+        Загружает коды, сохраненные прерванным запуском для этого же файла
+        
+        Returns:
+            dict: Словарь {текст: код_ОКПД}
+        """
+        codes = {}
+        self._codes_checkpoint_path = f"{self._cache_base_name()}.{self._input_digest()}.jsonl"
+        if not os.path.exists(self._codes_checkpoint_path):
+            return codes
+        
+        try:
+            with open(self._codes_checkpoint_path, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        codes.update(json.loads(line))
+            self.logger.info(f"Восстановлено {len(codes)} кодов из {self._codes_checkpoint_path}")
+        except Exception as e:
+            self.logger.warning(f"Не удалось прочитать чекпоинт {self._codes_checkpoint_path}: {e}")
+        return codes
+    
+    def _flush_codes_checkpoint(self, chunk):
+        """Дописывает порцию найденных кодов в файл чекпоинта одной строкой JSON"""
+        if not chunk or not self._codes_checkpoint_path:
+            return
+        try:
+            with open(self._codes_checkpoint_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(chunk, ensure_ascii=False) + '\n')
+            self.logger.info(f"Сохранено {len(chunk)} кодов в чекпоинт {self._codes_checkpoint_path}")
+        except Exception as e:
+            self.logger.warning(f"Ошибка при сохранении чекпоинта: {e}")
+    
+    def _remove_codes_checkpoint(self):
+        """Удаляет файл чекпоинта после успешной записи результата"""
+        if self._codes_checkpoint_path and os.path.exists(self._codes_checkpoint_path):
+            try:
+                os.remove(self._codes_checkpoint_path)
+            except OSError as e:
+                self.logger.warning(f"Не удалось удалить чекпоинт {self._codes_checkpoint_path}: {e}")
+    
+    def _load_simplify_cache(self):
+        """Загружает кэш упрощенных названий из каталога cache_dir"""
+        self._simplify_cache_path = f"{self._cache_base_name()}.simplify.json"
+        if not os.path.exists(self._simplify_cache_path):
+            return
+        
+        try:
+            with open(self._simplify_cache_path, encoding='utf-8') as f:
+                self._simplify_cache.update(json.load(f))
+            self.logger.info(f"Загружено {len(self._simplify_cache)} упрощенных названий из {self._simplify_cache_path}")
+        except Exception as e:
+            self.logger.warning(f"Не удалось прочитать кэш {self._simplify_cache_path}: {e}")
+    
+    def _save_simplify_cache(self):
+        """Сохраняет кэш упрощенных названий, если в нем появились новые записи"""
+        if not self._simplify_cache_dirty or not self._simplify_cache_path:
+            return
+        try:
+            # Кэш общий для параллельных обработок: файл заменяется целиком, без недописанных версий
+            tmp_path = f"{self._simplify_cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._simplify_cache, f, ensure_ascii=False)
+            os.replace(tmp_path, self._simplify_cache_path)
+            self._simplify_cache_dirty = False
+        except Exception as e:
+            self.logger.warning(f"Ошибка при сохранении кэша {self._simplify_cache_path}: {e}")
+    
+    def _simplify_terms(self, normalized_terms):
+        """
+        Упрощает нормализованные названия моделью, возвращая термины в том же порядке.
+        
+        Названия из кэша повторно не упрощаются, остальные генерируются одним пакетом;
+        при ошибке генерации вместо упрощенного используется нормализованное название.
+        """
+        missing = [term for term in dict.fromkeys(normalized_terms) if term not in self._simplify_cache]
+        if missing:
+            prompts = [self._simplify_prompt(term) for term in missing]
+            responses = self.model.generate_many(prompts, workers=SIMPLIFY_WORKERS)
+            for term, resp in zip(missing, responses):
+                if resp is None:
+                    self.logger.error(f"Ошибка упрощения названия '{term}'")
+                    continue
+                self._simplify_cache[term] = resp['content']
+                self._simplify_cache_dirty = True
+        return [self._simplify_cache.get(term, term) for term in normalized_terms]
+    
+    @staticmethod
+    def _simplify_prompt(normalized):
+        """Промпт для упрощения названия товара"""
+        return [
+            {"role": "system", "content": 'Ты помогаешь выбрать один код для военной компании, которая занимается производством и работает с различным металом, где производят Системы термостатирования и контроля температурно влажностного режима.'},
+            {"role": "user", "content": f"Перефразируй название товара, удалив все размеры и числовые параметры, преобразовав тип товара.\nЕсли встречаешь металические изделия, то прибавляй алюминевый. \n \
+                            Если слово 'лист' -> 'профиль алюминевый', если слово 'круг' -> 'профиль алюминевый, если слово 'болт' или 'винт -> 'болты и винты', если слово 'гвоздь' -> 'гвоздь', если слово 'доска' или 'брусок' -> 'пиломатериалы', если слово 'жгут' -> 'жгуты синтетические', если слово 'бензин' -> 'бензин', если слово 'бензин' -> 'бензин', если слово 'вилка или розетка' -> 'Разъемы и розетки',  если слово 'припой ПОС' -> 'Припой ПОС'.\n \
+                            Если встречаешь слово на английском языке - ничего не меняй. Напрмиер: если слово 'Isolontape 500 3005 VB D LM' -> 'Isolontape' \
+                            Если встречаешь слово которого нет в примерах, ориентируйся и сделай на подобии. \
+                            \nНазвание: {normalized}\nВыведи только товар:"}
+        ]
+    
     def _process_file(self):
         """Обработка файла формата 4_1"""
         try:
@@ -220,22 +557,27 @@ class FullFormatProcessor(BaseProcessor):
                 self.logger.error(f"Файл не найден: {self.input_path}")
                 return False
                 
+            excel_file = None
+            context_executor = None
             try:
-                # Открываем файл с помощью openpyxl для получения списка листов
-                workbook = openpyxl.load_workbook(self.input_path)
-                sheet_names = workbook.sheetnames
+                # Файл разбирается pandas один раз: список листов, заголовки и данные листов
+                # читаются из уже открытой книги
+                excel_file = pd.ExcelFile(self._input_stream(), engine=PANDAS_EXCEL_ENGINE)
+                self._excel_file = excel_file
+                sheet_names = excel_file.sheet_names
                 sheet_count = len(sheet_names)
                 self.logger.info(f"Файл содержит {sheet_count} листов: {', '.join(sheet_names)}")
                 
-                # Сохраняем workbook для дальнейшего использования
-                self.workbook = workbook
-                
                 # Новый подход: собираем все элементы со всех листов сначала
-                all_items = []  # Список всех элементов [{'text': '...', 'sheet': '...', 'row': N}]
-                all_unique_items = set()  # Множество уникальных текстов элементов
+                all_items = []  # Список всех элементов [(лист, индекс строки, текст)]
+                all_unique_items = {}  # Уникальные тексты элементов в порядке первого появления (dict как упорядоченное множество)
                 
                 # 1. Собираем элементы со всех листов
                 for sheet_idx, sheet_name in enumerate(sheet_names, start=1):
+                    if self.stop_event.is_set():
+                        self.logger.info("Обработка остановлена пользователем")
+                        return False
+                    
                     self.logger.info(f"Сканирование листа {sheet_idx}/{sheet_count}: '{sheet_name}'")
                     
                     # Устанавливаем текущий лист
@@ -253,27 +595,38 @@ class FullFormatProcessor(BaseProcessor):
                     
                     # Читаем данные из текущего листа
                     try:
-                        # Читаем данные из конкретного листа
-                        self.df = pd.read_excel(self.input_path, sheet_name=sheet_name)
+                        # Читаем только колонку наименований и без строк заголовка: строки заголовка таблицы
+                        # и первая строка листа (заголовок колонок pandas) пропускаются при разборе
+                        self.df = excel_file.parse(
+                            sheet_name,
+                            header=None,
+                            skiprows=self._num_header_rows + 1,
+                            usecols=[self.name_column_index - 1]
+                        )
+                        # Индекс как при полном чтении листа: строка Excel = индекс + 2
+                        self.df.index += self._num_header_rows
                         self.logger.info(f"Лист '{sheet_name}' прочитан для анализа, обнаружено {self.df.shape[0]} строк, {self.df.shape[1]} столбцов")
                         
                         # Собираем элементы с текущего листа
                         sheet_items = self._collect_items_from_sheet()
                         
-                        for item in sheet_items:
-                            all_items.append({
-                                'text': item[1],
-                                'sheet': sheet_name,
-                                'row': item[0]
-                            })
-                            all_unique_items.add(item[1])
+                        # Кортежи вместо словарей: по одному небольшому объекту на элемент
+                        all_items.extend((sheet_name, row, text) for row, text in sheet_items)
+                        all_unique_items.update(dict.fromkeys(text for _, text in sheet_items))
                             
                         self.logger.info(f"Найдено {len(sheet_items)} элементов на листе '{sheet_name}'")
                         
+                        # Данные листа больше не нужны: в памяти остается только список элементов
+                        self.df = None
+                        
                     except Exception as e:
                         self.logger.warning(f"Ошибка при чтении листа '{sheet_name}': {e}")
                         continue
                 
+                excel_file.close()
+                excel_file = None
+                self._excel_file = None
+                
                 # Статистика собранных элементов
                 self.logger.info(f"Всего найдено {len(all_items)} элементов на всех листах")
                 self.logger.info(f"Уникальных элементов: {len(all_unique_items)}")
@@ -296,169 +649,135 @@ class FullFormatProcessor(BaseProcessor):
                 self.logger.info(f"Сгруппировано в {len(groups)} групп")
                 
                 # 3. Обрабатываем каждую группу и получаем коды ОКПД
-                codes_by_item = {}  # Словарь {текст: код_ОКПД}
+                # Коды, найденные прерванным запуском для этого же файла, повторно не запрашиваем
+                codes_by_item = self._load_codes_checkpoint()  # Словарь {текст: код_ОКПД}
+                pending_codes = {}  # Коды, еще не записанные в чекпоинт
+                self._load_simplify_cache()
                 
-                # Безопасная работа с прогрессом
+                # Безопасная работа с прогрессом; группы обрабатываются порциями по GROUP_BATCH_SIZE
+                batch_starts = range(0, len(groups), GROUP_BATCH_SIZE)
                 if self.progress is not None:
                     self.progress(0, desc=f"Обработка групп...", total=len(groups))
-                    progress_iter = self.progress.tqdm(groups, desc=f"Получение кодов ОКПД")
+                    progress_iter = self.progress.tqdm(batch_starts, desc="Получение кодов ОКПД", total=len(batch_starts))
                 else:
-                    progress_iter = groups
+                    progress_iter = batch_starts
                 
-                for idx, group in enumerate(progress_iter, start=1):
-                    if self.stop_event.is_set():
-                        self.logger.info("Обработка остановлена пользователем")
-                        break
-                        
-                    if not group:
-                        continue
-                    
-                    # Берем представителя группы
-                    rep = group[0]
-                    
-                    # Дополнительная проверка перед обработкой
-                    # Проверяем снова чтобы не пропустить служебные строки
-                    is_service_line = False
-                    for i, pattern in enumerate(self.SKIP_PATTERNS_COMPILED):
-                        if pattern.search(rep):
-                            self.logger.warning(f"Пропускаем служебную строку (повторная проверка): '{rep}' (соответствует шаблону {i+1}: {self.SKIP_PATTERNS[i]})")
-                            is_service_line = True
+                # Контекст для выбора кода (веб-поиск) загружается в фоне, пока модель упрощает названия порции
+                context_executor = ThreadPoolExecutor(max_workers=WEB_SEARCH_WORKERS)
+                
+                # Браузер для запросов кодов ОКПД запускается один раз на все порции
+                with okpd2_session():
+                    for start in progress_iter:
+                        if self.stop_event.is_set():
+                            self.logger.info("Обработка остановлена пользователем")
                             break
-                    
-                    if is_service_line:
-                        continue
-                    
-                    try:
-                        # Нормализуем термин
-                        normalized = normalize_term(rep)
-                        self.logger.info(f"Обработка группы {idx}/{len(groups)}: {normalized}")
                         
-                        # Получаем упрощенный термин
-                        prompt = [
-                            {"role": "system", "content": 'Ты помогаешь выбрать один код для военной компании, которая занимается производством и работает с различным металом, где производят Системы термостатирования и контроля температурно влажностного режима.'},
-                            {"role": "user", "content": f"Перефразируй название товара, удалив все размеры и числовые параметры, преобразовав тип товара.\nЕсли встречаешь металические изделия, то прибавляй алюминевый. \n \
-                            Если слово 'лист' -> 'профиль алюминевый', если слово 'круг' -> 'профиль алюминевый, если слово 'болт' или 'винт -> 'болты и винты', если слово 'гвоздь' -> 'гвоздь', если слово 'доска' или 'брусок' -> 'пиломатериалы', если слово 'жгут' -> 'жгуты синтетические', если слово 'бензин' -> 'бензин', если слово 'бензин' -> 'бензин', если слово 'вилка или розетка' -> 'Разъемы и розетки',  если слово 'припой ПОС' -> 'Припой ПОС'.\n \
-                            Если встречаешь слово на английском языке - ничего не меняй. Напрмиер: если слово 'Isolontape 500 3005 VB D LM' -> 'Isolontape' \
-                            Если встречаешь слово которого нет в примерах, ориентируйся и сделай на подобии. \
-                            \nНазвание: {normalized}\nВыведи только товар:"}
-                            ]
-                        simplified = self.model.generate(prompt)['content']
-                        self.logger.info(f"Упрощено до: {simplified}")
-                        
-                        # Запрашиваем коды ОКПД
-                        okpd_data = fetch_okpd2_batch([simplified])
-                        entries = okpd_data.get(simplified, [])
-                        
-                        # Выбираем подходящий код
-                        code, name, comment = Processor._decide(self, entries, rep, simplified)
-                        self.logger.info(f"Выбран код: {code} - {name}")
+                        # Отбираем группы порции, которым еще нужен код
+                        batch = []  # [(номер группы, группа, представитель, нормализованный текст)]
+                        for idx, group in enumerate(groups[start:start + GROUP_BATCH_SIZE], start=start + 1):
+                            if not group or all(item in codes_by_item for item in group):
+                                continue
+                            
+                            # Берем представителя группы; служебные строки отфильтрованы при сборе элементов
+                            rep = group[0]
+                            
+                            try:
+                                batch.append((idx, group, rep, normalize_term(rep)))
+                            except Exception as e:
+                                self.logger.exception(f"Ошибка при обработке группы {idx}: {e}")
                         
-                        # Сохраняем код для каждого элемента в группе
-                        for item in group:
-                            codes_by_item[item] = code
+                        if batch:
+                            contexts = {
+                                rep: context_executor.submit(Processor._search_context, rep)
+                                for _, _, rep, _ in batch
+                            }
+                            try:
+                                # Упрощенные термины порции и коды ОКПД для них запрашиваются одним вызовом
+                                simplified_terms = self._simplify_terms([normalized for _, _, _, normalized in batch])
+                                okpd_data = fetch_okpd2_batch(list(dict.fromkeys(simplified_terms)))
+                                
+                                # Коды для всех групп порции выбираются одним пакетным вызовом модели
+                                decisions = Processor._decide_many(self, [
+                                    (okpd_data.get(simplified, []), rep, simplified, contexts[rep].result())
+                                    for (_, _, rep, _), simplified in zip(batch, simplified_terms)
+                                ])
+                            except Exception as e:
+                                self.logger.exception(f"Ошибка при обработке групп {start + 1}-{start + GROUP_BATCH_SIZE}: {e}")
+                                batch, simplified_terms, decisions = [], [], []
                             
-                    except Exception as e:
-                        self.logger.exception(f"Ошибка при обработке группы {idx}: {e}")
+                            for (idx, group, rep, normalized), simplified, decision in zip(batch, simplified_terms, decisions):
+                                if self.stop_event.is_set():
+                                    break
+                                try:
+                                    self.logger.info("Обработка группы %d/%d: %s -> %s", idx, len(groups), normalized, simplified)
+                                    if decision is None:
+                                        self.logger.error("Не удалось выбрать код для группы %d", idx)
+                                        continue
+                                    
+                                    code, name, comment = decision
+                                    self.logger.info("Выбран код: %s - %s", code, name)
+                                    
+                                    # Сохраняем код для каждого элемента в группе
+                                    for item in group:
+                                        codes_by_item[item] = code
+                                        pending_codes[item] = code
+                                        
+                                except Exception as e:
+                                    self.logger.exception(f"Ошибка при обработке группы {idx}: {e}")
+                        
+                        # Каждые save_interval групп сбрасываем порцию кодов на диск
+                        end = min(start + GROUP_BATCH_SIZE, len(groups))
+                        if end // self.save_interval > start // self.save_interval:
+                            self._flush_codes_checkpoint(pending_codes)
+                            pending_codes = {}
+                            self._save_simplify_cache()
+                
+                # Остаток порции сохраняем и при остановке, чтобы следующий запуск продолжил с этого места
+                self._flush_codes_checkpoint(pending_codes)
+                pending_codes = {}
+                self._save_simplify_cache()
                 
                 # 4. Проставляем коды для всех вхождений элементов
                 self.logger.info(f"Определены коды ОКПД для {len(codes_by_item)} уникальных элементов")
                 
-                # Создаем словарь для всех обновлений {sheet_name: {row: code}}
-                updates_by_sheet = {}
-                
-                # Проходим по всем найденным элементам и составляем план обновлений
-                for item in all_items:
-                    item_text = item['text']
-                    sheet_name = item['sheet']
-                    row = item['row']
-                    
-                    if item_text in codes_by_item:
-                        code = codes_by_item[item_text]
-                        
-                        # Инициализируем словарь для листа, если его еще нет
-                        if sheet_name not in updates_by_sheet:
-                            updates_by_sheet[sheet_name] = {}
-                            
-                        # Добавляем обновление для данной строки
-                        updates_by_sheet[sheet_name][row] = {
-                            'code': code,
-                            'item': item_text
-                        }
+                # Данные для записи одни на уникальный текст: нормализованный текст
+                # считается один раз, а не при каждой сверке строки
+                entries = {}
+                for text, code in codes_by_item.items():
+                    normalized = _normalize_cell_text(text)
+                    entries[text] = {
+                        'code': code,
+                        'item': text,
+                        'normalized': normalized,
+                        'no_spaces': normalized.replace(" ", ""),
+                    }
                 
-                # 5. Применяем обновления для каждого листа
-                total_updated = 0
+                # Коды для записи: (имя листа, индекс строки) -> код и текст элемента
+                self.results_to_update = {
+                    (sheet_name, row): entries[text]
+                    for sheet_name, row, text in all_items
+                    if text in entries
+                }
+                all_items = None
                 
-                for sheet_name, updates in updates_by_sheet.items():
-                    self.logger.info(f"Обновление листа '{sheet_name}': {len(updates)} элементов")
-                    
-                    # Переключаемся на нужный лист
-                    self.sheet_name = sheet_name
-                    
-                    # Явно получаем лист из рабочей книги
-                    if sheet_name in self.workbook.sheetnames:
-                        sheet = self.workbook[sheet_name]
-                    else:
-                        self.logger.warning(f"Лист '{sheet_name}' не найден в рабочей книге, пропускаем")
-                        continue
-                    
-                    # Перед обновлением листа, находим колонки заново
-                    success = self._find_columns_in_excel()
-                    if not success:
-                        self.logger.warning(f"Не удалось определить колонки на листе '{sheet_name}', пропускаем обновления")
-                        continue
-                    
-                    # Проверяем колонки перед обновлением
-                    if not self.name_column_index or not self.code_column_index:
-                        self.logger.warning(f"Не удалось определить колонки на листе '{sheet_name}', пропускаем")
-                        continue
-                    
-                    self.logger.info(f"Найдены колонки на листе '{sheet_name}': наименование({self.name_column_index}), код({self.code_column_index})")
-                    
-                    # Обновляем каждую ячейку
-                    sheet_updated = 0
-                    for row, data in updates.items():
-                        try:
-                            # Ячейка с кодом - добавляем +2 к индексу строки (+1 для нумерации Excel с 1, +1 для коррекции смещения)
-                            code_cell = sheet.cell(row=int(row)+2, column=self.code_column_index)
-                            old_value = code_cell.value
-                            
-                            # Для отладки: проверяем содержимое ячейки с наименованием
-                            name_cell = sheet.cell(row=int(row)+2, column=self.name_column_index)
-                            name_value = name_cell.value
-                            if name_value != data['item']:
-                                self.logger.info(f"Ожидаемый текст '{data['item']}', фактический '{name_value}' в строке {int(row)+2}")
-                            
-                            # Проверяем, содержит ли ячейка формулу
-                            if old_value and isinstance(old_value, str) and old_value.startswith('='):
-                                self.logger.warning(f"Ячейка ({sheet_name}:{row+2}, {self.code_column_index}) содержит формулу, пропускаем: {old_value}")
-                                continue
-                            
-                            # Обновляем значение
-                            code_cell.value = data['code']
-                            total_updated += 1
-                            sheet_updated += 1
-                            
-                            if total_updated % 100 == 0:
-                                self.logger.info(f"Обновлено {total_updated} ячеек...")
-                                
-                            if sheet_updated <= 5:  # Логируем первые 5 обновлений для каждого листа
-                                self.logger.info(f"Обновлена ячейка {sheet_name}:({int(row)+2}, {self.code_column_index}): '{old_value}' -> '{data['code']}' для '{name_value}'")
-                                
-                        except Exception as e:
-                            self.logger.warning(f"Ошибка при обновлении ячейки на листе '{sheet_name}', строка {row+2}: {e}")
-                    
-                    self.logger.info(f"Обновлено {sheet_updated} ячеек на листе '{sheet_name}'")
+                # 5. Записываем коды в строки, из которых были прочитаны элементы
+                if not self.preserve_formatting:
+                    # Быстрый путь: результат записывается потоком, исходный файл не изменяется
+                    try:
+                        total_updated = self._write_codes_streaming()
+                    except Exception as e:
+                        self.logger.exception(f"Ошибка при сохранении файла: {e}")
+                        return False
+                    self.logger.info(f"Результат сохранен в {self.output_path}, проставлено {total_updated} кодов ОКПД")
+                    if not self.stop_event.is_set():
+                        self._remove_codes_checkpoint()
+                    return True
                 
-                # 6. Сохраняем результаты
-                try:
-                    # Увеличиваем ширину колонки для кодов ОКПД
-                    self._adjust_column_width()
-                    
-                    self.workbook.save(self.input_path)
-                    self.logger.info(f"Файл успешно обновлен, проставлено {total_updated} кодов ОКПД")
-                except Exception as e:
-                    self.logger.error(f"Ошибка при сохранении файла: {e}")
+                # Полная (изменяемая) загрузка книги нужна только для записи кодов
+                if self.results_to_update and not self._update_excel_with_codes():
                     return False
+                if not self.stop_event.is_set():
+                    self._remove_codes_checkpoint()
                 
                 # Копируем исходный файл в output_path для интерфейса
                 try:
@@ -472,11 +791,93 @@ class FullFormatProcessor(BaseProcessor):
             except Exception as e:
                 self.logger.exception(f"Ошибка при обработке листов Excel: {e}")
                 return False
+            finally:
+                if context_executor is not None:
+                    context_executor.shutdown(cancel_futures=True)
+                if excel_file is not None:
+                    excel_file.close()
+                self._excel_file = None
+                self._close_read_only_workbook()
             
         except Exception as e:
             self.logger.exception(f"Ошибка в FullFormatProcessor: {e}")
             return False
             
+    def _write_codes_streaming(self):
+        """
+        Записывает результат без сохранения форматирования: строки всех листов исходного файла
+        копируются в новую книгу в режиме write_only с подставленными кодами ОКПД.
+        
+        Переносятся значения и формулы; стили, объединения ячеек и прочее оформление не переносятся.
+        Код записывается только в строку, где наименование совпадает с текстом элемента: поиск строки
+        по содержимому листа выполняется лишь при записи с сохранением форматирования.
+        
+        Returns:
+            int: Количество записанных кодов
+        """
+        source = openpyxl.load_workbook(self._input_stream(), read_only=True)
+        target = openpyxl.Workbook(write_only=True)
+        total_updated = 0
+        
+        # Коды по листам: {имя листа: {индекс строки: данные}}
+        updates_by_sheet = {}
+        for (sheet_name, row_idx), data in self.results_to_update.items():
+            updates_by_sheet.setdefault(sheet_name, {})[row_idx] = data
+        
+        try:
+            for sheet_name in source.sheetnames:
+                target_sheet = target.create_sheet(title=sheet_name)
+                updates = updates_by_sheet.get(sheet_name, {})
+                
+                self.sheet_name = sheet_name
+                code_column = self.code_column_index if self._find_columns_in_excel() else None
+                if code_column:
+                    # Ширина колонки кодов, как в _adjust_column_width: втрое больше стандартной
+                    target_sheet.column_dimensions[get_column_letter(code_column)].width = 8.43 * 3
+                    # Строка Excel = индекс строки + 2 (см. чтение листа): (код, ожидаемый текст, он же нормализованный)
+                    codes = {int(row) + 2: (data['code'], data['item'], data['normalized']) for row, data in updates.items()}
+                    if self.code_header_row:
+                        codes.setdefault(self.code_header_row, ("Код ОКП/ОКПД2", None, None))
+                else:
+                    codes = {}
+                
+                sheet_updated = 0
+                # Цикл идет по каждой строке листа: атрибуты и методы привязаны к локальным именам
+                get_update = codes.get
+                append_row = target_sheet.append
+                name_column = self.name_column_index
+                header_row = self.code_header_row
+                # Размер листа из тега <dimension> бывает неверным, а в read_only режиме iter_rows
+                # обрезает по нему строки и колонки: сбрасываем его и читаем все строки файла
+                source_sheet = source[sheet_name]
+                source_sheet.reset_dimensions()
+                for excel_row, values in enumerate(source_sheet.iter_rows(values_only=True), start=1):
+                    update = get_update(excel_row)
+                    if update is not None:
+                        code, item_text, item_normalized = update
+                        values = list(values) + [None] * (max(code_column, name_column) - len(values))
+                        old_value = values[code_column - 1]
+                        name_value = values[name_column - 1]
+                        if item_text is not None and _normalize_cell_text(name_value) != item_normalized:
+                            self.logger.warning("Ожидаемый текст '%s', фактический '%s' в строке %s:%s, пропускаем", item_text, name_value, sheet_name, excel_row)
+                        elif isinstance(old_value, str) and old_value.startswith('='):
+                            self.logger.warning("Ячейка (%s:%s, %s) содержит формулу, пропускаем: %s", sheet_name, excel_row, code_column, old_value)
+                        else:
+                            values[code_column - 1] = code
+                            if excel_row != header_row:
+                                sheet_updated += 1
+                    append_row(values)
+                
+                total_updated += sheet_updated
+                if updates:
+                    self.logger.info(f"Обновлено {sheet_updated} ячеек на листе '{sheet_name}'")
+            
+            save_workbook(target, self.output_path)
+        finally:
+            source.close()
+        
+        return total_updated
+    
     def _collect_items_from_sheet(self):
         """
         Собирает элементы с текущего листа, пропуская служебные строки
@@ -484,107 +885,332 @@ class FullFormatProcessor(BaseProcessor):
         Returns:
             list: Список кортежей (индекс_строки, текст_элемента)
         """
-        items_collected = []
-        
-        # Счетчики для анализа пропущенных строк
-        headers_skipped = 0
-        empty_skipped = 0
-        patterns_skipped = 0
-        total_rows = 0
-        
         # Проверяем, определены ли колонки
         if self.name_column_index is None:
             self.logger.error(f"Не определен индекс колонки с наименованиями для листа {self.sheet_name}")
             return []
         
-        # Определяем имя колонки с наименованиями
+        self.logger.info(f"Используем колонку {self.name_column_index} для наименований на листе {self.sheet_name}")
+            
+        # Все фильтры считаются по колонке целиком строковыми методами pandas, без iterrows.
+        # Лист прочитан без строк заголовка и содержит только колонку наименований
+        body = self.df.iloc[:, 0]
+        headers_skipped = self._num_header_rows
+        total_rows = headers_skipped + len(body)
+        
+        # Пропускаем пустые ячейки, одиночные символы и короткие числа;
+        # isdigit проверяется только для текстов длиной 2-3 символа, длинные отсекает сравнение длины
+        texts = body[body.notna()].astype(str).str.strip()
+        lengths = texts.str.len()
+        meaningful = lengths > 1
+        short = texts[meaningful & (lengths <= 3)]
+        meaningful.loc[short.index[short.str.isdigit().astype(bool)]] = False
+        empty_skipped = len(body) - int(meaningful.sum())
+        texts = texts[meaningful]
+        
+        # Проверяем по шаблонам служебных строк (объединенное выражение или автомат слов)
+        is_service = self._service_mask(texts)
+        patterns_skipped = int(is_service.sum())
+        
+        # Номер сработавшего шаблона нужен только для лога пропущенных строк
+        skipped_lines = []
+        for idx, item_text in texts[is_service].items():
+            i = self._match_skip_pattern(item_text)
+            skipped_lines.append(f"  [{idx}] '{item_text}' (шаблон {i+1}: {self.SKIP_PATTERNS[i]})")
+        
+        items = texts[~is_service]
+        items_collected = list(zip(items.index.tolist(), items.tolist()))
+        
+        # Обновляем счетчики для логирования
+        self.skipped_rows = headers_skipped + empty_skipped
+        self.skipped_service_rows = patterns_skipped
+        
+        if skipped_lines:
+            self.logger.info("Пропущены служебные строки:\n%s", "\n".join(skipped_lines))
+        
+        self.logger.info(
+            "Всего строк на листе: %d; пропущено строк заголовка: %d, пустых строк: %d, служебных строк: %d; собрано элементов: %d",
+            total_rows, headers_skipped, empty_skipped, patterns_skipped, len(items_collected)
+        )
+        
+        return items_collected
+    
+    def _scan_name_column(self, ro_sheet, cell_content_map):
+        """Добавляет в карту нормализованные тексты колонки наименований листа: текст -> (имя листа, строка)"""
+        self.logger.info(f"Сканирование листа '{ro_sheet.title}' для поиска элементов")
+        
+        # Размер листа из тега <dimension> бывает неверным, а в read_only режиме iter_rows
+        # не читает строки за его пределами: сбрасываем его
+        ro_sheet.reset_dimensions()
+        
+        # Значения колонки наименований одним проходом, без обращения к ячейкам по координатам
+        name_col = self.name_column_index
+        title = ro_sheet.title
+        name_values = ro_sheet.iter_rows(min_col=name_col, max_col=name_col, values_only=True)
+        for row, (cell_value,) in enumerate(name_values, start=1):
+            if cell_value:
+                # Нормализуем текст ячейки для лучшего сравнения
+                normalized_text = _normalize_cell_text(str(cell_value))
+                
+                if normalized_text:
+                    # Сохраняем строку и лист
+                    location = (title, row)
+                    cell_content_map[normalized_text] = location
+                    
+                    # Добавляем также версию без пробелов
+                    no_spaces = normalized_text.replace(" ", "")
+                    if no_spaces != normalized_text:
+                        cell_content_map[no_spaces] = location
+    
+    def _items_in_content_map(self, items, cell_content_map):
+        """
+        Ищет элементы в карте по точному тексту, затем по тексту без пробелов.
+        
+        Частичные совпадения ищутся при записи кодов только для остальных элементов.
+        
+        Returns:
+            dict: {текст элемента: (имя листа, строка, найден ли текст только без пробелов)}
+        """
+        items_found = {}
+        for data in items:
+            # Строки с одинаковым текстом ссылаются на одни и те же данные
+            if data['item'] in items_found:
+                continue
+            location = cell_content_map.get(data['normalized'])
+            if location is not None:
+                items_found[data['item']] = (*location, False)
+                continue
+            location = cell_content_map.get(data['no_spaces'])
+            if location is not None:
+                items_found[data['item']] = (*location, True)
+        return items_found
+    
+    def _write_code(self, sheet, excel_row, col_idx, code):
+        """
+        Записывает код в ячейку изменяемой книги, не трогая ячейки с формулами
+        
+        Returns:
+            bool: True если код записан
+        """
         try:
-            if 'Наименование' in self.df.columns:
-                item_column_name = 'Наименование'
-            elif self.name_column_index and self.name_column_index - 1 < len(self.df.columns):
-                # Преобразуем индекс колонки openpyxl (с 1) в индекс pandas (с 0)
-                item_column_name = self.df.columns[self.name_column_index - 1]
-            else:
-                # Попробуем найти колонку по ключевым словам
-                for col in self.df.columns:
-                    if 'наименов' in str(col).lower():
-                        item_column_name = col
-                        self.logger.info(f"Найдена колонка c наименованиями по ключевому слову: {col}")
-                        break
-                else:
-                    self.logger.error(f"Не удалось определить колонку с наименованиями на листе {self.sheet_name}")
-                    return []
+            cell = sheet.cell(row=excel_row, column=col_idx)
+            old_value = cell.value
+            
+            # Проверяем, содержит ли ячейка формулу
+            if old_value and isinstance(old_value, str) and old_value.startswith('='):
+                self.logger.warning("Ячейка (%s:%s, %s) содержит формулу, пропускаем: %s", sheet.title, excel_row, col_idx, old_value)
+                return False
+            
+            cell.value = code
+            self.logger.debug("Обновлена ячейка %s:(%s, %s): '%s' -> '%s'", sheet.title, excel_row, col_idx, old_value, code)
+            return True
         except Exception as e:
-            self.logger.error(f"Ошибка при определении колонки с наименованиями: {e}")
+            self.logger.warning("Ошибка при обновлении ячейки %s:(%s, %s): %s", sheet.title, excel_row, col_idx, e)
+            return False
+    
+    @staticmethod
+    def _best_partial_matches(queries, choices, min_ratio=0.8):
+        """
+        Для каждого запроса ищет среди choices строку, которая содержит запрос или содержится в нем,
+        с наибольшим отношением длин (строго больше min_ratio)
+        
+        Returns:
+            list: [(найденная строка или None, отношение длин)] в порядке запросов
+        """
+        if not queries:
             return []
+        
+        # Отношение длин больше min_ratio возможно только для строк с длиной в интервале
+        # (L * min_ratio, L / min_ratio), поэтому строки сортируются по длине и каждый запрос
+        # сравнивается только с окном подходящих длин. Порядок внутри окна восстанавливается
+        # по исходным индексам, чтобы при равном отношении побеждала первая строка
+        choice_lengths = np.fromiter(map(len, choices), dtype=np.int64, count=len(choices))
+        order = np.argsort(choice_lengths, kind='stable')
+        lengths = choice_lengths[order]
+        
+        # Запросы одинаковой длины сравниваются с одним окном
+        positions_by_length = {}
+        for position, query in enumerate(queries):
+            positions_by_length.setdefault(len(query), []).append(position)
+        
+        if fuzz is None:
+            # Без RapidFuzz кандидаты отбираются по инвертированному индексу биграмм
+            bigram_index = {}
+            bigram_counts = []
+            for index, key in enumerate(choices):
+                key_bigrams = _bigrams(key)
+                bigram_counts.append(len(key_bigrams))
+                for bigram in key_bigrams or ('',):
+                    bigram_index.setdefault(bigram, set()).add(index)
+        
+        candidates_by_query = [[] for _ in queries]
+        for length, positions in positions_by_length.items():
+            lo = int(np.searchsorted(lengths, length * min_ratio, side='left'))
+            hi = int(np.searchsorted(lengths, length / min_ratio, side='right'))
+            if lo >= hi:
+                continue
+            window_index = order[lo:hi].tolist()
+            group = [queries[position] for position in positions]
             
-        self.logger.info(f"Используем колонку '{item_column_name}' для наименований на листе {self.sheet_name}")
+            if fuzz is not None:
+                # partial_ratio = 100 ровно тогда, когда более короткая строка входит в более длинную;
+                # матрица сходства группы запросов с окном считается одним вызовом RapidFuzz
+                window = [choices[index] for index in window_index]
+                scores = fuzz_process.cdist(group, window, scorer=fuzz.partial_ratio, score_cutoff=100,
+                                            dtype=np.uint8, workers=-1)
+                for position, row in zip(positions, scores):
+                    candidates_by_query[position] = sorted(window_index[i] for i in np.flatnonzero(row))
+            else:
+                min_length, max_length = int(lengths[lo]), int(lengths[hi - 1])
+                for position, query in zip(positions, group):
+                    shortlist = _containment_shortlist(query, bigram_index, bigram_counts)
+                    candidates_by_query[position] = sorted(
+                        index for index in shortlist
+                        if min_length <= len(choices[index]) <= max_length
+                        and (query in choices[index] or choices[index] in query)
+                    )
+        
+        # Для строки, входящей в другую, расстояние Левенштейна равно разности длин, поэтому
+        # отношение длин совпадает с нормированным сходством по Левенштейну и считается по длинам
+        key_lengths = choice_lengths.tolist()
+        matches = []
+        for query, candidates in zip(queries, candidates_by_query):
+            query_length = len(query)
+            best_key, best_ratio = None, min_ratio
+            for index in candidates:
+                key_length = key_lengths[index]
+                ratio = min(query_length, key_length) / max(query_length, key_length)
+                if ratio > best_ratio:
+                    best_key, best_ratio = choices[index], ratio
+            matches.append((best_key, best_ratio))
+        return matches
+    
+    def _update_by_content(self, sheet, items, allow_cross_sheet=False):
+        """
+        Записывает коды элементов, строку которых нужно найти по тексту наименования
+        
+        Args:
+            sheet: Лист изменяемой книги, с которого были прочитаны элементы
+            items: Список словарей {'code': ..., 'item': ..., 'normalized': ..., 'no_spaces': ...}
+            allow_cross_sheet: Искать не найденные на листе элементы на остальных листах
             
-        # Проходим по всем строкам, пропуская указанное количество строк заголовка
-        for idx, row in enumerate(self.df.iterrows()):
-            idx, row = row  # Распаковываем кортеж (индекс, Series)
-            total_rows += 1
+        Returns:
+            int: Количество записанных кодов
+        """
+        updated = 0
+        
+        # Создаем словарь для поиска текстов по содержимому листа: текст -> (имя листа, строка)
+        cell_content_map = {}
+        
+        # Содержимое листов читается из книги в режиме только для чтения;
+        # изменяемая книга нужна только для записи кодов
+        if not self._ro_workbook:
+            self._ro_workbook = openpyxl.load_workbook(self._input_stream(), read_only=True, data_only=True)
+        
+        # Выводим список элементов для отладки
+        if len(items) < 10:
+            elements_to_find = [data['item'] for data in items]
+            self.logger.info(f"Ищем элементы: {elements_to_find}")
+        else:
+            self.logger.info(f"Ищем {len(items)} элементов")
+        
+        # Элементы были прочитаны с этого листа, поэтому карта строится по нему
+        self._scan_name_column(self._ro_workbook[sheet.title], cell_content_map)
+        items_found = self._items_in_content_map(items, cell_content_map)
+        
+        # Другие листы просматриваются только по запросу и только если часть элементов не найдена;
+        # при совпадении текста приоритет остается за текущим листом
+        if allow_cross_sheet and len(items_found) < len(items):
+            other_map = {}
+            for sheet_name in self._ro_workbook.sheetnames:
+                if sheet_name != sheet.title:
+                    self._scan_name_column(self._ro_workbook[sheet_name], other_map)
+            other_map.update(cell_content_map)
+            cell_content_map = other_map
+            items_found = self._items_in_content_map(items, cell_content_map)
+        
+        # Отладочная информация о найденных элементах
+        found_percent = len(items_found) / len(items) * 100 if items else 0
+        self.logger.info(f"Построена карта содержимого листов: найдено {len(items_found)} из {len(items)} элементов ({found_percent:.1f}%)")
+        
+        # Если не найдены некоторые элементы, выведем их для отладки
+        if len(items_found) < len(items) and len(items) - len(items_found) < 10:
+            missing = [data['item'] for data in items if data['item'] not in items_found]
+            self.logger.warning(f"Не найдены элементы: {missing}")
+        elif len(items_found) < len(items):
+            self.logger.warning(f"Не найдено {len(items) - len(items_found)} элементов")
+        
+        # Частичные совпадения ищутся одним пакетом для всех элементов без точного совпадения;
+        # короткие строки карты не участвуют
+        choices = [key for key in cell_content_map if len(key) >= 5]
+        # Строки с одинаковым текстом ищутся один раз
+        partial_queries = list(dict.fromkeys(
+            data['normalized'] for data in items if data['item'] not in items_found
+        ))
+        partial_matches = dict(zip(partial_queries, self._best_partial_matches(partial_queries, choices)))
+        
+        # Найденные строки: {имя листа: [(строка Excel, код)]}
+        writes_by_sheet = {}
+        for data in items:
+            code = data['code']
+            item_text = data['item']
             
-            # Пропускаем первые N строк (заголовки таблицы)
-            if idx < self._num_header_rows:
-                headers_skipped += 1
-                self.logger.debug(f"Пропускаем строку {idx} (часть заголовка)")
-                continue
+            # Проверяем, найден ли элемент в карте содержимого
+            found = False
             
-            # Проверяем наличие колонки в row
-            if item_column_name not in row:
-                self.logger.warning(f"Колонка '{item_column_name}' отсутствует в строке {idx}")
-                empty_skipped += 1
-                continue
-                
-            # Пропускаем пустые ячейки
-            if pd.isna(row[item_column_name]):
-                empty_skipped += 1
-                continue
+            # Точное совпадение или совпадение без пробелов найдено при построении карты
+            exact = items_found.get(item_text)
+            if exact is not None:
+                target_title, excel_row, without_spaces = exact
+                if without_spaces:
+                    self.logger.info("Найдено соответствие без пробелов для '%s' в листе '%s', строка %s", item_text, target_title, excel_row)
+                else:
+                    self.logger.info("Найдено точное соответствие для '%s' в листе '%s', строка %s", item_text, target_title, excel_row)
+                found = True
+            else:
+                # Если точного совпадения нет, попробуем найти по частичному совпадению
+                best_key, best_ratio = partial_matches[data['normalized']]
                 
-            item_text = str(row[item_column_name]).strip()
+                if best_key is not None:
+                    target_title, excel_row = cell_content_map[best_key]
+                    # Текст найденной ячейки читается из книги только если сообщение будет выведено
+                    if self.logger.isEnabledFor(logging.INFO):
+                        cell_value = self.workbook[target_title].cell(row=excel_row, column=self.name_column_index).value
+                        self.logger.info("Найдено частичное соответствие для '%s' в листе '%s', строка %s: '%s' (совпадение %.2f)",
+                                         item_text, target_title, excel_row, cell_value, best_ratio)
+                    found = True
             
-            # Пропускаем пустые строки и одиночные символы
-            if not item_text or len(item_text) <= 1:
-                empty_skipped += 1
-                continue
-                
-            # Пропускаем, если это число или короткое число
-            if item_text.isdigit() and len(item_text) <= 3:
-                empty_skipped += 1
+            # Если не найдено совпадение, пропускаем элемент
+            if not found:
+                self.logger.warning("Не удалось найти строку с текстом '%s' ни в одном листе, пропускаем", item_text)
                 continue
             
-            # Проверяем по шаблонам служебных строк
-            skip_item = False
-            for i, pattern in enumerate(self.SKIP_PATTERNS_COMPILED):
-                if pattern.search(item_text):
-                    skip_item = True
-                    patterns_skipped += 1
-                    self.logger.info(f"Пропускаем служебную строку [{idx}]: '{item_text}' (соответствует шаблону {i+1}: {self.SKIP_PATTERNS[i]})")
-                    break
-                    
-            if skip_item:
-                continue
-                
-            # Добавляем элемент в список
-            items_collected.append((idx, item_text))
+            writes_by_sheet.setdefault(target_title, []).append((excel_row, code))
         
-        # Обновляем счетчики для логирования
-        self.skipped_rows = headers_skipped + empty_skipped
-        self.skipped_service_rows = patterns_skipped
-        
-        self.logger.info(f"Всего строк на листе: {total_rows}")
-        self.logger.info(f"Пропущено строк заголовка: {headers_skipped}")
-        self.logger.info(f"Пропущено пустых строк: {empty_skipped}")
-        self.logger.info(f"Пропущено служебных строк: {patterns_skipped}")
-        self.logger.info(f"Собрано элементов: {len(items_collected)}")
+        # Коды записываются по листам в порядке строк; сортировка устойчива, поэтому
+        # при нескольких кодах для одной строки, как и раньше, остается последний
+        for target_title, writes in writes_by_sheet.items():
+            target_sheet = self.workbook[target_title]
+            if target_title != sheet.title:
+                self.logger.info(f"Переключаемся на лист '{target_title}' для обновления {len(writes)} ячеек")
+            writes.sort(key=lambda write: write[0])
+            for excel_row, code in writes:
+                if self._write_code(target_sheet, excel_row, self.code_column_index, code):
+                    updated += 1
         
-        return items_collected
+        return updated
     
-    def _update_excel_with_codes(self):
+    def _update_excel_with_codes(self, allow_cross_sheet=False):
         """
         Обновляет коды ОКПД в исходном Excel-файле, сохраняя форматирование
         
+        Ключи self.results_to_update - (имя листа, индекс строки): код записывается прямо в строку,
+        из которой был прочитан элемент (строка Excel = индекс + 2). Строка ищется по содержимому
+        листа только для элементов, текст которых в этой строке не совпал.
+        
+        Args:
+            allow_cross_sheet: Искать не найденные на листе элементы на остальных листах
+        
         Returns:
             bool: True если успешно, False в случае ошибки
         """
@@ -599,179 +1225,59 @@ class FullFormatProcessor(BaseProcessor):
         try:
             # Если есть открытый workbook, используем его
             if not self.workbook:
-                self.workbook = openpyxl.load_workbook(self.input_path)
-                
-            # Используем указанный лист, активный лист или первый лист
-            if self.sheet_name and self.sheet_name in self.workbook.sheetnames:
-                sheet = self.workbook[self.sheet_name]
-            else:
-                sheet = self.workbook.active
-                self.sheet_name = sheet.title
-                
-            self.logger.info(f"Обновление данных в листе '{sheet.title}'")
-            
-            # Счетчик обновлений
-            updated = 0
-            
-            # Создаем словарь для поиска текстов по содержимому листа
-            cell_content_map = {}
-            items_found = set()
-            
-            # Список всех листов для поиска
-            sheets_to_search = [sheet]
+                self.workbook = openpyxl.load_workbook(self._input_stream())
             
-            # Если не нашли текст на текущем листе, попробуем поискать на других листах
-            if len(self.results_to_update) > 0 and self.workbook.sheetnames:
-                for sheet_name in self.workbook.sheetnames:
-                    if sheet_name != sheet.title:
-                        other_sheet = self.workbook[sheet_name]
-                        sheets_to_search.append(other_sheet)
-                        self.logger.info(f"Добавлен лист '{sheet_name}' для поиска элементов")
+            # Обновления по листам: {имя листа: [(строка Excel, код, нормализованный текст, данные)]},
+            # поля данных извлекаются один раз до цикла записи
+            updates_by_sheet = {}
+            for (sheet_name, row_idx), data in self.results_to_update.items():
+                updates_by_sheet.setdefault(sheet_name, []).append(
+                    (int(row_idx) + 2, data['code'], data['normalized'], data)
+                )
             
-            # Выводим список элементов для отладки
-            if len(self.results_to_update) < 10:
-                elements_to_find = [data['item'] for _, data in self.results_to_update.items()]
-                self.logger.info(f"Ищем элементы: {elements_to_find}")
-            else:
-                self.logger.info(f"Ищем {len(self.results_to_update)} элементов")
-            
-            # Проверяем каждый лист для построения карты
-            for current_sheet in sheets_to_search:
-                self.logger.info(f"Сканирование листа '{current_sheet.title}' для поиска элементов")
-                
-                for row in range(1, current_sheet.max_row + 1):
-                    # Ищем ячейку с названием элемента
-                    name_col = self.name_column_index
-                    cell = current_sheet.cell(row=row, column=name_col)
-                    
-                    if cell.value:
-                        # Нормализуем текст ячейки для лучшего сравнения
-                        cell_text = str(cell.value)
-                        normalized_text = self._normalize_cell_text(cell_text)
-                        
-                        if normalized_text:
-                            # Сохраняем строку и лист
-                            cell_content_map[normalized_text] = (current_sheet, row)
-                            
-                            # Добавляем также версию без пробелов
-                            no_spaces = normalized_text.replace(" ", "")
-                            if no_spaces != normalized_text:
-                                cell_content_map[no_spaces] = (current_sheet, row)
-                            
-                            # Проверяем, нашли ли мы какой-то из искомых элементов
-                            for _, data in self.results_to_update.items():
-                                item_text = data['item']
-                                item_norm = self._normalize_cell_text(item_text)
-                                
-                                if (item_norm == normalized_text or 
-                                    item_norm.replace(" ", "") == no_spaces or
-                                    normalized_text in item_norm or 
-                                    item_norm in normalized_text):
-                                    items_found.add(item_text)
-            
-            # Отладочная информация о найденных элементах
-            found_percent = len(items_found) / len(self.results_to_update) * 100 if self.results_to_update else 0
-            self.logger.info(f"Построена карта содержимого листов: найдено {len(items_found)} из {len(self.results_to_update)} элементов ({found_percent:.1f}%)")
-            
-            # Если не найдены некоторые элементы, выведем их для отладки
-            if len(items_found) < len(self.results_to_update) and len(self.results_to_update) - len(items_found) < 10:
-                missing = [data['item'] for _, data in self.results_to_update.items() if data['item'] not in items_found]
-                self.logger.warning(f"Не найдены элементы: {missing}")
-            elif len(items_found) < len(self.results_to_update):
-                self.logger.warning(f"Не найдено {len(self.results_to_update) - len(items_found)} элементов")
-            
-            for row_idx, data in self.results_to_update.items():
-                code = data['code']
-                column_name = data['column_name']
-                item_text = data['item']
-                
-                # Нормализуем текст элемента для лучшего сравнения
-                item_normalized = self._normalize_cell_text(item_text)
-                item_no_spaces = item_normalized.replace(" ", "")
-                
-                # Определяем номер колонки для кода ОКПД
-                if isinstance(column_name, int):
-                    # Если индекс pandas (с 0), преобразуем в индекс openpyxl (с 1)
-                    col_idx = column_name + 1
-                else:
-                    # Если это название колонки, найдем соответствующий индекс
-                    col_idx = self.code_column_index
+            total_updated = 0
+            for sheet_name, updates in updates_by_sheet.items():
+                if sheet_name not in self.workbook.sheetnames:
+                    self.logger.warning(f"Лист '{sheet_name}' не найден в рабочей книге, пропускаем")
+                    continue
+                sheet = self.workbook[sheet_name]
                 
-                if not col_idx:
-                    self.logger.warning(f"Не удалось определить колонку для кода ОКПД")
+                # Колонки листа (результат анализа закэширован при сборе элементов)
+                self.sheet_name = sheet_name
+                if not self._find_columns_in_excel() or not self.name_column_index or not self.code_column_index:
+                    self.logger.warning(f"Не удалось определить колонки на листе '{sheet_name}', пропускаем")
                     continue
                 
-                # Номер строки в Excel (строка в pandas + header_rows + 1 для учета индексации с 0)
-                excel_row = int(row_idx) + 1
-                target_sheet = sheet  # По умолчанию текущий лист
+                self.logger.info(f"Обновление листа '{sheet_name}': {len(updates)} элементов, наименование({self.name_column_index}), код({self.code_column_index})")
+                self._write_code_header(sheet)
                 
-                # Проверяем, найден ли элемент в карте содержимого
-                found = False
+                sheet_updated = 0
+                unresolved = []  # Элементы, текст которых не совпал с их строкой
+                name_column = self.name_column_index
+                code_column = self.code_column_index
+                for excel_row, code, item_normalized, data in updates:
+                    name_value = sheet.cell(row=excel_row, column=name_column).value
+                    if _normalize_cell_text(name_value) != item_normalized:
+                        unresolved.append(data)
+                        continue
+                    if self._write_code(sheet, excel_row, code_column, code):
+                        sheet_updated += 1
                 
-                # Пробуем точное совпадение
-                if item_normalized in cell_content_map:
-                    target_sheet, excel_row = cell_content_map[item_normalized]
-                    self.logger.info(f"Найдено точное соответствие для '{item_text}' в листе '{target_sheet.title}', строка {excel_row}")
-                    found = True
-                # Пробуем версию без пробелов
-                elif item_no_spaces in cell_content_map:
-                    target_sheet, excel_row = cell_content_map[item_no_spaces]
-                    self.logger.info(f"Найдено соответствие без пробелов для '{item_text}' в листе '{target_sheet.title}', строка {excel_row}")
-                    found = True
-                else:
-                    # Если точного совпадения нет, попробуем найти по частичному совпадению
-                    best_match = None
-                    best_ratio = 0.8  # Минимальный порог сходства (80%)
-                    best_key = None
-                    
-                    # Поиск методом частичного совпадения
-                    for key, (s, row) in cell_content_map.items():
-                        # Пропускаем короткие строки
-                        if len(key) < 5:
-                            continue
-                            
-                        # Проверяем, содержит ли текст ячейки наш элемент
-                        if item_normalized in key or key in item_normalized:
-                            ratio = len(min(item_normalized, key, key=len)) / len(max(item_normalized, key, key=len))
-                            if ratio > best_ratio:
-                                best_ratio = ratio
-                                best_match = (s, row)
-                                best_key = key
-                    
-                    if best_match:
-                        target_sheet, excel_row = best_match
-                        cell_value = target_sheet.cell(row=excel_row, column=self.name_column_index).value
-                        self.logger.info(f"Найдено частичное соответствие для '{item_text}' в листе '{target_sheet.title}', строка {excel_row}: '{cell_value}' (совпадение {best_ratio:.2f})")
-                        found = True
-                
-                # Если не найдено совпадение, пропускаем элемент
-                if not found:
-                    self.logger.warning(f"Не удалось найти строку с текстом '{item_text}' ни в одном листе, пропускаем")
-                    continue
+                if unresolved:
+                    self.logger.info(f"На листе '{sheet_name}' {len(unresolved)} элементов не совпали со своей строкой, ищем по содержимому")
+                    sheet_updated += self._update_by_content(sheet, unresolved, allow_cross_sheet)
                 
-                # Записываем код в ячейку
-                try:
-                    # Если лист отличается от текущего, запоминаем это
-                    if target_sheet.title != sheet.title:
-                        self.logger.info(f"Переключаемся на лист '{target_sheet.title}' для обновления ячейки")
-                    
-                    cell = target_sheet.cell(row=excel_row, column=col_idx)
-                    old_value = cell.value
-                    
-                    # Проверяем, содержит ли ячейка формулу
-                    if old_value and isinstance(old_value, str) and old_value.startswith('='):
-                        self.logger.warning(f"Ячейка ({target_sheet.title}:{excel_row}, {col_idx}) содержит формулу, пропускаем: {old_value}")
-                        continue
-                    
-                    cell.value = code
-                    updated += 1
-                    self.logger.debug(f"Обновлена ячейка {target_sheet.title}:({excel_row}, {col_idx}): '{old_value}' -> '{code}'")
-                except Exception as e:
-                    self.logger.warning(f"Ошибка при обновлении ячейки {target_sheet.title}:({excel_row}, {col_idx}): {e}")
+                total_updated += sheet_updated
+                self.logger.info(f"Обновлено {sheet_updated} ячеек на листе '{sheet_name}'")
+            
+            # Увеличиваем ширину колонки для кодов ОКПД
+            self._adjust_column_width()
             
             # Сохраняем изменения
-            self.workbook.save(self.input_path)
-            self.logger.info(f"Файл Excel обновлен: {updated} кодов ОКПД добавлено")
+            self._close_read_only_workbook()
+            save_workbook(self.workbook, self.input_path)
+            self._invalidate_input_stream()
+            self.logger.info(f"Файл Excel обновлен: {total_updated} кодов ОКПД добавлено")
             
             return True
             
@@ -779,29 +1285,6 @@ class FullFormatProcessor(BaseProcessor):
             self.logger.exception(f"Ошибка при обновлении Excel файла: {e}")
             return False
             
-    def _normalize_cell_text(self, text):
-        """Нормализует текст ячейки для сравнения"""
-        if not text:
-            return ""
-            
-        # Преобразуем в строку
-        text = str(text)
-        
-        # Заменяем неразрывные пробелы на обычные
-        text = text.replace('\xa0', ' ')
-        
-        # Убираем лишние пробелы
-        text = " ".join(text.split())
-        
-        # Удаляем непечатаемые символы
-        text = ''.join(c for c in text if c.isprintable())
-        
-        # Игнорируем специальные символы, которые могут различаться
-        text = text.replace('-', ' ').replace('_', ' ').replace('.', ' ').replace(',', ' ')
-        text = " ".join(text.split())
-        
-        return text.strip().lower()  # Приводим к нижнему регистру для регистронезависимого сравнения 
-
     def _adjust_column_width(self):
         """
         Увеличивает ширину колонки с кодами ОКПД в 3 раза на всех листах
@@ -826,6 +1309,8 @@ class FullFormatProcessor(BaseProcessor):
                 success = self._find_columns_in_excel()
                 
                 if success and self.code_column_index:
+                    self._write_code_header(sheet)
+                    
                     # Получаем букву колонки из ее индекса
                     col_letter = get_column_letter(self.code_column_index)
                     
@@ -2,25 +2,31 @@
 Обработчик для многолистовых Excel-файлов
 """
 
+import numpy as np
 import pandas as pd
 import os
 import shutil
 from main import Processor, group_similar
 from src.morphology import normalize_term
 from src.okpd_fetch import fetch_okpd2_batch
+from src.excel_io import PANDAS_EXCEL_ENGINE
 from .base_processor import BaseProcessor
 
 class MultiSheetProcessor(BaseProcessor):
     """Процессор для Excel-файлов с несколькими листами"""
     
+    # Начала строк с итогами, которые не обрабатываются
+    TOTAL_PREFIXES = ('ВСЕГО', 'Итого')
+    
     def _process_file(self):
         """Обработка многолистового файла"""
+        excel_file = None
         try:
             # Получение пути к входному файлу
             input_path = self.input_path
             
-            # Чтение файла для получения имен листов
-            excel_file = pd.ExcelFile(input_path)
+            # Файл открывается один раз, все листы читаются из этого же объекта
+            excel_file = pd.ExcelFile(input_path, engine=PANDAS_EXCEL_ENGINE)
             sheet_names = excel_file.sheet_names
             self.logger.info(f"Found {len(sheet_names)} sheets in the file")
             
@@ -43,32 +49,27 @@ class MultiSheetProcessor(BaseProcessor):
                     if self.progress is not None:
                         self.progress(sheet_idx, desc=f"Processing sheet: {sheet_name}", total=total_sheets)
                     
-                    # Чтение листа
-                    df = pd.read_excel(input_path, sheet_name=sheet_name)
-                    
-                    # Поиск индексов колонок
-                    item_col_idx, code_col_idx, doc_col_idx = self._find_columns(df)
+                    # Колонки ищутся по первым строкам; лист без колонки наименования целиком не читается
+                    header_df = excel_file.parse(sheet_name, nrows=10)
+                    item_col_idx, code_col_idx, doc_col_idx = self._find_columns(header_df.to_numpy(dtype=object))
                     
                     # Если нашли колонку наименования, продолжаем обработку
                     if item_col_idx is not None:
+                        # Чтение листа
+                        df = excel_file.parse(sheet_name)
+                        
+                        # Значения листа одним массивом: все проходы по ячейкам идут по нему, минуя df.iloc
+                        values = df.to_numpy(dtype=object)
+                        
                         self.logger.info(f"Found columns - Item: {item_col_idx}, Code: {code_col_idx}, Doc: {doc_col_idx}")
                         
-                        # Поиск фактических строк данных (после заголовков)
-                        data_rows = self._find_data_rows(df, item_col_idx, doc_col_idx)
+                        # Поиск строк с данными и сбор элементов за один проход
+                        items_to_process = self._find_data_rows(values, item_col_idx, doc_col_idx)
                         
                         # Обработка элементов
-                        total_items = len(data_rows)
+                        total_items = len(items_to_process)
                         self.logger.info(f"Found {total_items} items to process in sheet {sheet_name}")
                         
-                        # Группировка элементов для пакетной обработки
-                        items_to_process = []
-                        for row_idx in data_rows:
-                            if pd.isna(df.iloc[row_idx, item_col_idx]):
-                                continue
-                            item_value = str(df.iloc[row_idx, item_col_idx]).strip()
-                            if item_value and item_value != '-':
-                                items_to_process.append((row_idx, item_value))
-                        
                         # Обработка элементов пакетами
                         batch_size = min(10, len(items_to_process))
                         for batch_start in range(0, len(items_to_process), batch_size):
@@ -140,57 +141,63 @@ class MultiSheetProcessor(BaseProcessor):
         except Exception as e:
             self.logger.exception(f"Error in multi-sheet processing: {e}")
             return False
+        finally:
+            if excel_file is not None:
+                excel_file.close()
     
-    def _find_columns(self, df):
-        """Поиск индексов колонок в DataFrame"""
-        item_col_idx = None
-        code_col_idx = None
-        doc_col_idx = None
+    def _find_columns(self, values):
+        """Поиск индексов колонок в массиве значений листа"""
+        # Первые 10 строк одним строковым массивом; пустые ячейки становятся 'nan'/'None' и ничему не соответствуют
+        header = np.char.lower(values[:10].astype(str))
         
-        # Поиск в первых 10 строках
-        for row_idx in range(min(10, df.shape[0])):
-            for col_idx in range(df.shape[1]):
-                if pd.isna(df.iloc[row_idx, col_idx]):
-                    continue
-                
-                cell_value = str(df.iloc[row_idx, col_idx]).lower()
-                
-                # Проверка на идентификаторы колонок
-                if '№' in cell_value and 'п/п' in cell_value:
-                    pass  # Колонка с номерами, игнорируем
-                elif 'наименование' in cell_value:
-                    item_col_idx = col_idx
-                elif 'код' in cell_value and ('окп' in cell_value or 'окпд' in cell_value):
-                    code_col_idx = col_idx
-                elif ('первич' in cell_value and 'докум' in cell_value) or 'договор' in cell_value:
-                    doc_col_idx = col_idx
+        def contains(token):
+            return np.char.find(header, token) >= 0
+        
+        # Идентификаторы колонок проверяются в порядке приоритета, как цепочка if/elif по ячейке
+        numbering = contains('№') & contains('п/п')  # Колонка с номерами, игнорируем
+        is_item = ~numbering & contains('наименование')
+        is_code = ~numbering & ~is_item & contains('код') & contains('окп')
+        is_doc = ~numbering & ~is_item & ~is_code & (
+            (contains('первич') & contains('докум')) | contains('договор')
+        )
         
-        return item_col_idx, code_col_idx, doc_col_idx
+        # При нескольких совпадениях берется последнее (по строкам, затем по колонкам)
+        def last_column(mask):
+            hits = np.argwhere(mask)
+            return int(hits[-1][1]) if len(hits) else None
+        
+        return last_column(is_item), last_column(is_code), last_column(is_doc)
     
-    def _find_data_rows(self, df, item_col_idx, doc_col_idx):
-        """Поиск строк с данными для обработки"""
-        data_rows = []
-        for row_idx in range(df.shape[0]):
-            if pd.isna(df.iloc[row_idx, item_col_idx]):
-                continue
-                
-            item_value = str(df.iloc[row_idx, item_col_idx]).strip()
-            
-            # Пропускаем заголовки строк и строки c итогами
-            if (item_value.lower() == 'наименование' or 
-                item_value.startswith('ВСЕГО') or 
-                item_value.startswith('Итого')):
-                continue
+    def _find_data_rows(self, values, item_col_idx, doc_col_idx):
+        """
+        Поиск строк с данными для обработки
+        
+        Returns:
+            list: Список кортежей (индекс_строки, текст_элемента)
+        """
+        # Фильтры считаются по колонкам целиком строковыми методами pandas, а не по ячейкам
+        item_series = pd.Series(values[:, item_col_idx], dtype=object)
+        item_text = item_series[item_series.notna()].astype(str).str.strip()
+        
+        # Пропускаем пустые значения, заголовки строк и строки c итогами
+        keep = ~(
+            item_text.isin(['', '-']) |
+            (item_text.str.lower() == 'наименование') |
+            item_text.str.startswith(self.TOTAL_PREFIXES)
+        )
+        item_text = item_text[keep]
+        
+        # Пропускаем строки с "Приложение" в колонке документов
+        if doc_col_idx is not None:
+            doc_series = pd.Series(values[:, doc_col_idx], dtype=object)
+            is_appendix = doc_series.notna() & doc_series.astype(str).str.contains('прил', case=False, regex=False)
+            appendix_rows = is_appendix[item_text.index]
+            skipped_docs = item_text.index[appendix_rows.to_numpy()].tolist()
+            item_text = item_text[~appendix_rows]
             
-            # Пропускаем строки с "Приложение" в колонке документов
-            should_skip = False
-            if doc_col_idx is not None and not pd.isna(df.iloc[row_idx, doc_col_idx]):
-                doc_value = str(df.iloc[row_idx, doc_col_idx]).lower()
-                if 'прил' in doc_value:
-                    self.logger.info(f"Skipping row {row_idx} due to 'Приложения' in doc field")
-                    should_skip = True
-                    
-            if not should_skip:
-                data_rows.append(row_idx)
+            if skipped_docs:
+                self.logger.info("Skipping %d rows due to 'Приложения' in doc field: %s", len(skipped_docs), skipped_docs)
+        
+        items = list(zip(item_text.index.tolist(), item_text.tolist()))
                 
-        return data_rows 
\ No newline at end of file
+        return items 
@@ -3,14 +3,18 @@
 """
 
 import os
-import pandas as pd
+import openpyxl
 from logger import setup_logger
+from src.excel_io import read_header_rows
 from .standard_processor import StandardProcessor
 from .full_format_processor import FullFormatProcessor
 from .multi_sheet_processor import MultiSheetProcessor
 
 logger = setup_logger('processor_factory')
 
+# Сколько колонок просматривать при определении структуры файла
+MAX_PROBE_COLUMNS = 100
+
 def create_processor(input_file, checkpoint_name="checkpoint.xlsx", save_interval=10, progress=None):
     """
     Фабричный метод для создания подходящего процессора на основе типа файла
@@ -31,39 +35,54 @@ def create_processor(input_file, checkpoint_name="checkpoint.xlsx", save_interva
     
     # Проверка наличия нескольких листов
     try:
-        excel_file = pd.ExcelFile(input_file.name)
-        sheet_names = excel_file.sheet_names
+        workbook = openpyxl.load_workbook(input_file.name, read_only=True, data_only=True)
+    except Exception as e:
+        logger.warning(f"Error detecting file format: {e}. Using StandardProcessor")
+        return StandardProcessor(input_file, checkpoint_name, save_interval, progress)
+    
+    try:
+        sheet_names = workbook.sheetnames
         if len(sheet_names) > 1:
             logger.info(f"Creating MultiSheetProcessor (found {len(sheet_names)} sheets)")
             return MultiSheetProcessor(input_file, checkpoint_name, save_interval, progress)
+        
+        # Проверка структуры файла: читаем только строку заголовка и 10 строк данных
+        rows = read_header_rows(workbook, max_row=11, max_col=MAX_PROBE_COLUMNS)
     except Exception as e:
-        logger.warning(f"Error checking for multiple sheets: {e}")
+        # При ошибке используем стандартный процессор
+        logger.warning(f"Error detecting file format: {e}. Using StandardProcessor")
+        return StandardProcessor(input_file, checkpoint_name, save_interval, progress)
+    finally:
+        workbook.close()
     
-    # Проверка структуры файла
     try:
-        # Чтение первых строк файла для определения структуры
-        df_test = pd.read_excel(input_file.name, nrows=10)
+        header = rows[0] if rows else ()
+        # Ширина таблицы - до последней непустой ячейки в прочитанных строках
+        width = max(
+            (idx + 1 for row in rows for idx, value in enumerate(row) if value is not None),
+            default=0
+        )
         
         # Если стандартных колонок нет, это может быть формат 4_1
-        if 'Наименование' not in df_test.columns:
-            # Пробуем проверить, похоже ли на формат 4_1 (ищем специфические паттерны)
-            df_test_noheader = pd.read_excel(input_file.name, header=None, nrows=10)
-            
+        if 'Наименование' not in header:
             # Проверяем, присутствуют ли типичные для 4_1 колонки/контент
             has_section_header = False
             has_complex_structure = False
             
             # Ищем заголовки разделов типа "Сырье и основные материалы:"
-            for idx, row in df_test_noheader.iterrows():
-                for col in range(df_test_noheader.shape[1]):
-                    if not pd.isna(row[col]) and isinstance(row[col], str):
-                        if ('материалы' in str(row[col]).lower() and ':' in str(row[col])) or 'наименование' in str(row[col]).lower():
+            for row in rows:
+                for value in row:
+                    if isinstance(value, str):
+                        text = value.lower()
+                        if ('материалы' in text and ':' in text) or 'наименование' in text:
                             has_section_header = True
                             break
+                if has_section_header:
+                    break
             
             # Проверяем, большинство колонок не имеют имен (типично для формата 4_1)
-            unnamed_cols = sum(1 for col in df_test.columns if 'Unnamed:' in str(col))
-            if unnamed_cols > df_test.shape[1] / 2:  # Более половины колонок без имен
+            unnamed_cols = sum(1 for value in header[:width] if value is None)
+            if unnamed_cols > width / 2:  # Более половины колонок без имен
                 has_complex_structure = True
                 
             if has_section_header or has_complex_structure:
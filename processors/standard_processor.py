@@ -6,10 +6,14 @@ import pandas as pd
 import os
 import time
 import openpyxl
+import queue
 import shutil
-from main import Processor, group_similar
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from main import Processor, SIMPLIFY_WORKERS, WEB_SEARCH_WORKERS, group_similar
 from src.morphology import normalize_term
 from src.okpd_fetch import fetch_okpd2_batch
+from src.excel_io import PANDAS_EXCEL_ENGINE, header_tokens, save_workbook
 from .base_processor import BaseProcessor
 
 class StandardProcessor(BaseProcessor):
@@ -18,9 +22,13 @@ class StandardProcessor(BaseProcessor):
     def __init__(self, input_file=None, checkpoint_name="checkpoint.xlsx", save_interval=10, progress=None):
         super().__init__(input_file, checkpoint_name, save_interval, progress)
         
-        # Данные для обновления Excel файла
+        # Данные для обновления Excel файла: индекс строки -> (код, название, комментарий)
         self.results_to_update = {}
         
+        # Фоновая запись промежуточных результатов в Excel
+        self._write_queue = None
+        self._writer_thread = None
+        
         # Данные о файле
         self.workbook = None
         self.sheet_name = None
@@ -51,6 +59,43 @@ class StandardProcessor(BaseProcessor):
             self.logger.warning(f"Не удалось создать резервную копию: {e}")
         return None
     
+    def _start_checkpoint_writer(self):
+        """Запускает поток, который записывает промежуточные результаты в Excel параллельно с обработкой"""
+        # Очередь на один снимок: пока идет запись, обработка групп продолжается
+        self._write_queue = queue.Queue(maxsize=1)
+        self._writer_thread = threading.Thread(
+            target=self._checkpoint_writer_loop,
+            name=f"{self.__class__.__name__}-writer",
+            daemon=True
+        )
+        self._writer_thread.start()
+    
+    def _checkpoint_writer_loop(self):
+        """Цикл потока записи: берет снимки результатов из очереди до получения None"""
+        while True:
+            results = self._write_queue.get()
+            if results is None:
+                return
+            if self._update_excel_with_codes(results):
+                self.logger.info(f"Сохранен промежуточный результат: {len(results)} элементов")
+    
+    def _queue_checkpoint(self):
+        """Передает снимок текущих результатов потоку записи"""
+        try:
+            self._write_queue.put_nowait(dict(self.results_to_update))
+        except queue.Full:
+            # Предыдущий снимок еще не записан; следующий снимок включит и эти результаты
+            self.logger.info("Запись предыдущего промежуточного результата еще не завершена, пропускаем")
+    
+    def _stop_checkpoint_writer(self):
+        """Дожидается завершения записи и останавливает поток"""
+        if self._writer_thread is None:
+            return
+        self._write_queue.put(None)
+        self._writer_thread.join()
+        self._writer_thread = None
+        self._write_queue = None
+    
     def _find_columns_in_excel(self):
         """
         Находит колонки с наименованием и кодами ОКПД в файле Excel
@@ -61,45 +106,53 @@ class StandardProcessor(BaseProcessor):
             return False
             
         try:
-            # Открываем Excel файл
-            self.workbook = openpyxl.load_workbook(self.input_path)
+            # Открываем Excel файл в потоковом режиме: для поиска колонок достаточно первых строк
+            workbook = openpyxl.load_workbook(self._input_stream(), read_only=True, data_only=True)
             self.logger.info(f"Excel файл открыт: {self.input_path}")
-            
+        except Exception as e:
+            self.logger.exception(f"Ошибка при анализе Excel файла: {e}")
+            return False
+        
+        try:
             # Определяем активный лист (или первый, если активный не задан)
-            if self.workbook.active:
-                sheet = self.workbook.active
-                self.sheet_name = sheet.title
+            if workbook.active:
+                sheet = workbook.active
             else:
-                sheet = self.workbook.worksheets[0]
-                self.sheet_name = sheet.title
+                sheet = workbook.worksheets[0]
+            self.sheet_name = sheet.title
             
             self.logger.info(f"Анализируем лист: {self.sheet_name}")
             
+            # Размер листа из тега <dimension> бывает неверным, а в read_only режиме iter_rows
+            # обрезает по нему строки: сбрасываем его, строки читаются по фактическим ячейкам
+            sheet.reset_dimensions()
+            
+            # Значения первых 19 строк читаются одним проходом; дальше файл не разбирается
+            rows = list(sheet.iter_rows(min_row=1, max_row=19, values_only=True))
+            
             # Ищем в первых нескольких строках заголовки колонок
             name_column = None
             code_column = None
             
             # Проверяем первые 15 строк (обычно заголовки там)
-            max_check_row = min(15, sheet.max_row)
-            
-            for row in range(1, max_check_row + 1):
-                for col in range(1, min(20, sheet.max_column + 1)):
-                    cell_value = sheet.cell(row=row, column=col).value
-                    
+            for row_num, row in enumerate(rows[:15], start=1):
+                for col, cell_value in enumerate(row[:19], start=1):
                     if not cell_value:
                         continue
                         
-                    cell_text = str(cell_value).strip().lower()
+                    tokens = header_tokens(str(cell_value).strip().lower())
+                    if not tokens:
+                        continue
                     
                     # Ищем колонку с наименованием
-                    if cell_text == "наименование" or "наименов" in cell_text:
+                    if "наименов" in tokens:
                         name_column = col
-                        self.logger.info(f"Найдена колонка 'Наименование': строка {row}, колонка {col}")
+                        self.logger.info(f"Найдена колонка 'Наименование': строка {row_num}, колонка {col}")
                     
                     # Ищем колонку с кодом ОКПД
-                    if "окпд" in cell_text or "код окп" in cell_text:
+                    if "окпд" in tokens or "код окп" in tokens:
                         code_column = col
-                        self.logger.info(f"Найдена колонка с кодом ОКПД: строка {row}, колонка {col}")
+                        self.logger.info(f"Найдена колонка с кодом ОКПД: строка {row_num}, колонка {col}")
                     
                     # Если нашли обе колонки, завершаем поиск
                     if name_column and code_column:
@@ -107,28 +160,25 @@ class StandardProcessor(BaseProcessor):
                         self.code_column_index = code_column
                         return True
             
+            first_row = rows[0] if rows else ()
+            
             # Если не нашли колонку кода, но нашли наименование
             if name_column and not code_column:
                 self.name_column_index = name_column
                 # Ищем подходящую колонку для кодов
-                for col in range(1, sheet.max_column + 1):
-                    cell_value = sheet.cell(row=1, column=col).value
+                for col, cell_value in enumerate(first_row, start=1):
                     if cell_value and 'код' in str(cell_value).lower():
                         code_column = col
                         self.code_column_index = col
                         self.logger.info(f"Найдена колонка для кодов: {col}")
                         return True
                         
-                # Если не нашли подходящую, создаем новую колонку после наименования
+                # Если не нашли подходящую, используем новую колонку после наименования;
+                # заголовок для нее добавляется при записи кодов (_update_excel_with_codes)
                 code_column = name_column + 1
                 self.code_column_index = code_column
                 self.logger.info(f"Будем использовать колонку {code_column} для кодов ОКПД")
                 
-                # Добавляем заголовок в ячейку для кодов ОКПД
-                if sheet.cell(row=1, column=name_column).value:
-                    sheet.cell(row=1, column=code_column).value = "ОКПД код"
-                    self.logger.info(f"Добавлен заголовок 'ОКПД код' в строку 1, колонку {code_column}")
-                
                 return True
             
             # Не нашли нужные колонки
@@ -136,11 +186,12 @@ class StandardProcessor(BaseProcessor):
                 self.logger.error("Не удалось найти колонку 'Наименование'")
                 
                 # Поиск по содержимому - ищем колонку с наибольшим количеством текста
+                width = min(9, max((len(row) for row in rows), default=0))
                 text_counts = {}
-                for col in range(1, min(10, sheet.max_column + 1)):
+                for col in range(1, width + 1):
                     text_count = 0
-                    for row in range(1, min(20, sheet.max_row + 1)):
-                        cell_value = sheet.cell(row=row, column=col).value
+                    for row in rows:
+                        cell_value = row[col - 1] if col <= len(row) else None
                         if cell_value and isinstance(cell_value, str) and len(str(cell_value).strip()) > 5:
                             text_count += 1
                     text_counts[col] = text_count
@@ -163,6 +214,8 @@ class StandardProcessor(BaseProcessor):
         except Exception as e:
             self.logger.exception(f"Ошибка при анализе Excel файла: {e}")
             return False
+        finally:
+            workbook.close()
     
     def _process_file(self):
         """Обработка файла стандартного формата"""
@@ -178,7 +231,7 @@ class StandardProcessor(BaseProcessor):
             # Чтение файла pandas для обработки данных
             read_start = time.time()
             try:
-                self.df = pd.read_excel(self.input_path)
+                self.df = pd.read_excel(self._input_stream(), engine=PANDAS_EXCEL_ENGINE)
                 read_time = time.time() - read_start
                 self.logger.info(f"Файл прочитан для анализа за {read_time:.1f} сек. Обнаружено {self.df.shape[0]} строк, {self.df.shape[1]} столбцов")
             except Exception as e:
@@ -233,14 +286,13 @@ class StandardProcessor(BaseProcessor):
                 
             # Инициализация для хранения результатов
             self.results_to_update = {}
-            name_to_idx = {}
+            simplified_by_normalized = {}  # Нормализованное название -> упрощенный термин
             
-            # Создаем отображение наименований на индексы строк
-            for idx, row in self.df.iterrows():
-                if pd.notna(row[name_col]):
-                    item_text = str(row[name_col]).strip()
-                    if item_text:
-                        name_to_idx[item_text] = idx
+            # Создаем отображение наименований на индексы строк (по колонке целиком, без iterrows);
+            # при повторах текста, как и раньше, остается последняя строка
+            names = self.df[name_col].dropna().astype(str).str.strip()
+            names = names[names != '']
+            name_to_idx = dict(zip(names.tolist(), names.index.tolist()))
             
             # Инициализация индикатора прогресса
             total = len(groups)
@@ -251,71 +303,73 @@ class StandardProcessor(BaseProcessor):
             # Безопасно работаем с объектом прогресса
             if self.progress is not None:
                 self.progress(0.0, desc="Инициализация обработки...", total=total)
-                progress_iter = self.progress.tqdm(groups, desc="Обработка групп")
+                progress_iter = self.progress.tqdm(groups, desc="Обработка групп", total=total)
             else:
                 progress_iter = groups
             
-            # Обработка каждой группы
+            # Группы обрабатываются параллельно (генерация модели и запросы к сайту не держат GIL),
+            # результаты принимаются в основном потоке в исходном порядке групп;
+            # промежуточные результаты пишет отдельный поток. Веб-поиск контекста для выбора кода
+            # идет в своем пуле: число одновременных запросов ограничено WEB_SEARCH_WORKERS
             process_start = time.time()
-            for idx, grp in enumerate(progress_iter, start=1):
-                if self.stop_event.is_set():
-                    self.logger.info("Обработка остановлена пользователем")
-                    break
-                    
-                if not grp:
-                    continue
-                    
-                rep = grp[0]
-                processed_items += len(grp)
-                
-                try:
-                    # Обработка термина
-                    normalized = normalize_term(rep)
-                    self.logger.info(f"Обработка группы {idx}/{total}: {normalized}")
-                    
-                    # Получение упрощенного термина
-                    prompt = [{"role": "user", "content": normalized}]
-                    simplified = self.model.generate(prompt)['content']
-                    self.logger.info(f"Упрощено до: {simplified}")
-                    
-                    # Получение кодов ОКПД
-                    okpd_data = fetch_okpd2_batch([simplified])
-                    entries = okpd_data.get(simplified, [])
-                    
-                    # Выбор подходящего кода
-                    code, name, comment = Processor._decide(None, entries, rep, simplified)
-                    self.logger.info(f"Выбран код: {code} - {name}")
-                    
-                    # Добавляем результаты в словарь для обновления Excel
-                    for item in grp:
-                        if item in name_to_idx:
-                            row_idx = name_to_idx[item]
-                            self.results_to_update[row_idx] = {
-                                'code': code,
-                                'name': name,
-                                'comment': comment,
-                                'item': item
-                            }
-                            success_items += 1
-                    
-                    # Обновление статуса прогресса
-                    if self.progress is not None:
-                        percent = (idx / total) * 100
-                        remaining = total - idx
-                        self.progress(
-                            idx / total, 
-                            desc=f"Обработано {idx}/{total} групп ({percent:.1f}%), осталось {remaining}"
-                        )
+            self._start_checkpoint_writer()
+            executor = ThreadPoolExecutor(max_workers=SIMPLIFY_WORKERS)
+            context_executor = ThreadPoolExecutor(max_workers=WEB_SEARCH_WORKERS)
+            try:
+                futures = [
+                    executor.submit(self._process_group, grp, idx, total, simplified_by_normalized, context_executor)
+                    if grp else None
+                    for idx, grp in enumerate(groups, start=1)
+                ]
+                for idx, (grp, future) in enumerate(zip(progress_iter, futures), start=1):
+                    if self.stop_event.is_set():
+                        self.logger.info("Обработка остановлена пользователем")
+                        break
+                        
+                    if future is None:
+                        continue
+                        
+                    processed_items += len(grp)
                     
-                    # Сохранение промежуточных результатов
-                    if idx % int(self.save_interval) == 0:
-                        self._update_excel_with_codes()
-                        self.logger.info(f"Сохранен промежуточный результат: группа {idx}/{total}, обработано {processed_items} элементов")
+                    try:
+                        decision = future.result()
+                        if decision is None:
+                            # Группа пропущена после остановки
+                            continue
+                        code, name = decision[:2]
+                        self.logger.info("Выбран код: %s - %s", code, name)
                         
-                except Exception as e:
-                    self.logger.exception(f"Ошибка при обработке группы {idx}: {e}")
-                    error_items += len(grp)
-            
+                        # Добавляем результаты в словарь для обновления Excel:
+                        # строки группы ссылаются на один общий кортеж (код, название, комментарий)
+                        for item in grp:
+                            if item in name_to_idx:
+                                self.results_to_update[name_to_idx[item]] = decision
+                                success_items += 1
+                        
+                        # Обновление статуса прогресса
+                        if self.progress is not None:
+                            percent = (idx / total) * 100
+                            remaining = total - idx
+                            self.progress(
+                                idx / total, 
+                                desc=f"Обработано {idx}/{total} групп ({percent:.1f}%), осталось {remaining}"
+                            )
+                        
+                        # Сохранение промежуточных результатов
+                        if idx % int(self.save_interval) == 0:
+                            self._queue_checkpoint()
+                            self.logger.info(f"Передан на сохранение промежуточный результат: группа {idx}/{total}, обработано {processed_items} элементов")
+                            
+                    except Exception as e:
+                        self.logger.exception(f"Ошибка при обработке группы {idx}: {e}")
+                        error_items += len(grp)
+            finally:
+                # Еще не начатые группы после остановки или ошибки не запускаются
+                executor.shutdown(wait=True, cancel_futures=True)
+                context_executor.shutdown(wait=True, cancel_futures=True)
+            
+            # Финальная запись идет после того, как поток закончит текущую запись
+            self._stop_checkpoint_writer()
             process_time = time.time() - process_start
             self.logger.info(f"Обработка закончена за {process_time:.1f} сек")
             self.logger.info(f"Итого: обработано {success_items} из {processed_items} элементов, ошибок: {error_items}")
@@ -351,15 +405,60 @@ class StandardProcessor(BaseProcessor):
         except Exception as e:
             self.logger.exception(f"Критическая ошибка при обработке: {e}")
             return False
+        finally:
+            self._stop_checkpoint_writer()
     
-    def _update_excel_with_codes(self):
+    def _process_group(self, grp, idx, total, simplified_by_normalized, context_executor):
+        """
+        Выбирает код ОКПД для группы в рабочем потоке
+        
+        Args:
+            grp: Группа похожих наименований (первое - представитель)
+            idx: Номер группы (для журнала)
+            total: Общее число групп
+            simplified_by_normalized: Общий для потоков кэш упрощенных терминов
+            context_executor: Пул веб-поиска контекста для выбора кода
+        
+        Returns:
+            tuple: (код, наименование, комментарий) или None, если обработка остановлена
+        """
+        if self.stop_event.is_set():
+            return None
+        
+        rep = grp[0]
+        # Контекст ищется в пуле веб-поиска, пока модель упрощает термин
+        context = context_executor.submit(Processor._search_context, rep)
+        normalized = normalize_term(rep)
+        self.logger.info("Обработка группы %d/%d: %s", idx, total, normalized)
+        
+        # Представители разных групп с одинаковым нормализованным названием упрощаются моделью один раз
+        # (группы, обрабатываемые одновременно, могут упростить его повторно)
+        simplified = simplified_by_normalized.get(normalized)
+        if simplified is None:
+            prompt = [{"role": "user", "content": normalized}]
+            simplified = self.model.generate(prompt)['content']
+            simplified_by_normalized[normalized] = simplified
+        self.logger.info("Упрощено до: %s", simplified)
+        
+        # Получение кодов ОКПД и выбор подходящего
+        okpd_data = fetch_okpd2_batch([simplified])
+        entries = okpd_data.get(simplified, [])
+        return Processor._decide(self, entries, rep, simplified, context=context.result())
+    
+    def _update_excel_with_codes(self, results=None):
         """
         Обновляет коды ОКПД в исходном Excel-файле, сохраняя форматирование
         
+        Args:
+            results: Снимок результатов для записи (по умолчанию self.results_to_update)
+        
         Returns:
             bool: True если успешно, False в случае ошибки
         """
-        if not self.results_to_update:
+        if results is None:
+            results = self.results_to_update
+        
+        if not results:
             self.logger.warning("Нет данных для обновления Excel файла")
             return False
             
@@ -370,7 +469,7 @@ class StandardProcessor(BaseProcessor):
         try:
             # Если есть открытый workbook, используем его
             if not self.workbook:
-                self.workbook = openpyxl.load_workbook(self.input_path)
+                self.workbook = openpyxl.load_workbook(self._input_stream())
                 
             # Используем активный лист или первый лист
             if self.sheet_name:
@@ -404,11 +503,7 @@ class StandardProcessor(BaseProcessor):
             # Счетчик обновлений
             updated = 0
             
-            for row_idx, data in self.results_to_update.items():
-                code = data.get('code', '')
-                name = data.get('name', '')
-                comment = data.get('comment', '')
-                
+            for row_idx, (code, name, comment) in results.items():
                 # Индекс строки в Excel (строка в pandas + 1, т.к. openpyxl считает с 1)
                 excel_row = int(row_idx) + 1
                 
@@ -421,8 +516,9 @@ class StandardProcessor(BaseProcessor):
                 except Exception as e:
                     self.logger.warning(f"Ошибка при обновлении ячеек в строке {excel_row}: {e}")
             
-            # Сохраняем изменения
-            self.workbook.save(self.input_path)
+            # Сохраняем изменения; дальше книга остается открытой и файл не перечитывается
+            save_workbook(self.workbook, self.input_path)
+            self._invalidate_input_stream()
             self.logger.info(f"Файл Excel обновлен: {updated} элементов получили коды ОКПД")
             
             return True
@@ -450,10 +546,10 @@ class StandardProcessor(BaseProcessor):
                     result_df[col] = ''
             
             # Заполняем результаты
-            for row_idx, data in self.results_to_update.items():
-                result_df.loc[row_idx, 'ОКПД код'] = data.get('code', '')
-                result_df.loc[row_idx, 'Название кода'] = data.get('name', '')
-                result_df.loc[row_idx, 'Комментарий'] = data.get('comment', '')
+            for row_idx, (code, name, comment) in self.results_to_update.items():
+                result_df.loc[row_idx, 'ОКПД код'] = code
+                result_df.loc[row_idx, 'Название кода'] = name
+                result_df.loc[row_idx, 'Комментарий'] = comment
             
             # Сохраняем в новый файл
             result_df.to_excel(self.output_path, index=False)
@@ -0,0 +1,116 @@
+import logging
+import os
+import re
+import shutil
+import tempfile
+import openpyxl
+
+logger = logging.getLogger(__name__)
+
+# Движок pandas для чтения значений: python-calamine (Rust) заметно быстрее openpyxl
+try:
+    import python_calamine  # noqa: F401
+    PANDAS_EXCEL_ENGINE = "calamine"
+except ImportError:
+    logger.warning("python-calamine не установлен, для чтения Excel используется openpyxl")
+    PANDAS_EXCEL_ENGINE = "openpyxl"
+# Движок записи итоговых файлов через pandas: XlsxWriter пишет быстрее openpyxl
+try:
+    import xlsxwriter  # noqa: F401
+    PANDAS_WRITER_ENGINE = "xlsxwriter"
+    # Без автоматического распознавания ссылок: у XlsxWriter лимит на число URL на листе
+    PANDAS_WRITER_KWARGS = {"options": {"strings_to_urls": False, "strings_to_numbers": False}}
+except ImportError:
+    PANDAS_WRITER_ENGINE = "openpyxl"
+    PANDAS_WRITER_KWARGS = {}
+
+# Ключевые слова заголовков колонок одним шаблоном: текст ячейки просматривается за один проход.
+# Просмотр вперед (?=...) находит совпадения в каждой позиции, более длинные варианты идут первыми.
+_HEADER_TOKENS_RE = re.compile(r'(?=(наименов|код окп|окпд|окп|код))')
+
+
+def header_tokens(text):
+    """
+    Возвращает множество ключевых слов заголовка, встречающихся в тексте ячейки (в нижнем регистре).
+
+    Возможные значения: 'наименов', 'код окп', 'окпд', 'окп', 'код'.
+    """
+    tokens = set(_HEADER_TOKENS_RE.findall(text))
+    if 'код окп' in tokens:
+        tokens.add('код')
+    if 'окпд' in tokens:
+        tokens.add('окп')
+    return tokens
+
+
+def read_header_rows(source, sheet_name=None, max_row=15, max_col=20):
+    """
+    Читает значения только первых строк листа, не разбирая остальную часть файла.
+
+    source - путь к файлу или книга openpyxl, уже открытая в режиме read_only.
+    Возвращает список кортежей значений (по одному на строку, с 1-й строки листа).
+    """
+    workbook = source
+    owns_workbook = not isinstance(source, openpyxl.Workbook)
+    if owns_workbook:
+        workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+
+    try:
+        if sheet_name and sheet_name in workbook.sheetnames:
+            sheet = workbook[sheet_name]
+        else:
+            sheet = workbook.active
+
+        # В read_only режиме размер листа берется из тега <dimension>, который бывает неверным,
+        # и iter_rows обрезает по нему строки и колонки: строки читаются по фактическим ячейкам
+        if workbook.read_only:
+            sheet.reset_dimensions()
+
+        # iter_rows в потоковом режиме прекращает разбор XML после max_row
+        return [
+            tuple(values)
+            for values in sheet.iter_rows(min_row=1, max_row=max_row, max_col=max_col, values_only=True)
+        ]
+    finally:
+        if owns_workbook:
+            workbook.close()
+
+
+def write_dataframe(df, path, sheet_name="Sheet1"):
+    """
+    Записывает DataFrame в новый файл xlsx через openpyxl в режиме write_only.
+
+    Строки пишутся потоком, без построения дерева ячеек в памяти; пустые значения
+    (NaN/NaT/None) записываются пустыми ячейками, как в DataFrame.to_excel.
+    Файл сохраняется через save_workbook, поэтому сбой во время записи не портит предыдущую версию.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=sheet_name)
+    sheet.append([str(col) for col in df.columns])
+    values = df.astype(object).where(df.notna(), None)
+    for row in values.itertuples(index=False, name=None):
+        sheet.append(row)
+
+    save_workbook(workbook, path)
+
+
+def save_workbook(workbook, path):
+    """
+    Сохраняет книгу openpyxl, не оставляя недописанного файла при сбое.
+
+    Книга пишется во временный файл в том же каталоге, который затем атомарно
+    заменяет path; до этого момента прежнее содержимое path остается нетронутым.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(suffix=".xlsx", dir=directory)
+    os.close(fd)
+    try:
+        workbook.save(tmp_path)
+        # mkstemp создает файл с правами 0600; заменяемый файл сохраняет свои права доступа
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -3,6 +3,8 @@ import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from typing import List, Dict, Union
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 logger = logging.getLogger(__name__)
@@ -120,48 +122,23 @@ class Model:
         self.top_p = top_p
         self.max_new_tokens = max_new_tokens
 
-    def generate(
-        self,
-        prompt: Union[str, List[Dict[str, str]]],
-        temperature: float = None,
-        top_p: float = None,
-        max_new_tokens: int = None,
-    ) -> dict:
-        # Параметры генерации
-        temperature = temperature if temperature is not None else self.temperature
-        top_p = top_p if top_p is not None else self.top_p
-        max_new_tokens = max_new_tokens if max_new_tokens is not None else self.max_new_tokens
-
+    def _render(self, prompt: Union[str, List[Dict[str, str]]]) -> str:
+        """Переводит промпт в текст по шаблону чата модели (с учётом thinking)"""
         # Если prompt — не список, оборачиваем в формат чата
         if isinstance(prompt, list):
             messages = prompt
         else:
             messages = [{"role": "user", "content": prompt}]
 
-        # Генерация текста с учётом thinking
-        text = self.tokenizer.apply_chat_template(
+        return self.tokenizer.apply_chat_template(
             messages,
             tokenize=False,
             add_generation_prompt=True,
             enable_thinking=True
         )
 
-
-        # Токенизация и перенос на устройство модели
-        model_inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
-
-        # Генерация токенов
-        generated_ids = self.model.generate(
-            **model_inputs,
-            do_sample=True,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_new_tokens
-        )
-
-        # Отделяем сгенерированные токены от prompt'а
-        output_ids = generated_ids[0][len(model_inputs.input_ids[0]):].tolist()
-
+    def _decode(self, output_ids: List[int]) -> dict:
+        """Делит сгенерированные токены на блок thinking и основной ответ"""
         # Пытаемся найти границу мыслительного блока
         try:
             # Токен `</think>` имеет id 151668 в Qwen3
@@ -177,3 +154,96 @@ class Model:
             "thinking": thinking,
             "content": content
         }
+
+    def generate(
+        self,
+        prompt: Union[str, List[Dict[str, str]]],
+        temperature: float = None,
+        top_p: float = None,
+        max_new_tokens: int = None,
+    ) -> dict:
+        return self.generate_batch([prompt], temperature, top_p, max_new_tokens)[0]
+
+    def generate_batch(
+        self,
+        prompts: List[Union[str, List[Dict[str, str]]]],
+        temperature: float = None,
+        top_p: float = None,
+        max_new_tokens: int = None,
+    ) -> List[dict]:
+        """
+        Генерирует ответы на несколько промптов одним вызовом model.generate.
+
+        Промпты дополняются слева до общей длины, поэтому сгенерированные токены
+        всех строк пакета начинаются с одной позиции.
+        """
+        # Параметры генерации
+        temperature = temperature if temperature is not None else self.temperature
+        top_p = top_p if top_p is not None else self.top_p
+        max_new_tokens = max_new_tokens if max_new_tokens is not None else self.max_new_tokens
+
+        texts = [self._render(prompt) for prompt in prompts]
+
+        # Токенизация и перенос на устройство модели
+        model_inputs = self.tokenizer(
+            texts, return_tensors="pt", padding=True, padding_side="left"
+        ).to(self.model.device)
+
+        # Генерация токенов
+        generated_ids = self.model.generate(
+            **model_inputs,
+            do_sample=True,
+            temperature=temperature,
+            top_p=top_p,
+            max_new_tokens=max_new_tokens
+        )
+
+        # Отделяем сгенерированные токены от prompt'а; токены дополнения отбрасываются при декодировании
+        prompt_length = model_inputs.input_ids.shape[1]
+        return [self._decode(ids[prompt_length:].tolist()) for ids in generated_ids]
+
+    def generate_many(
+        self,
+        prompts: List[Union[str, List[Dict[str, str]]]],
+        workers: int = 4,
+        batch_size: int = 8,
+        **kwargs,
+    ) -> List[Union[dict, None]]:
+        """
+        Генерирует ответы для списка промптов пакетами по batch_size, сохраняя порядок.
+
+        Если генерация пакета упала, его промпты генерируются по одному в пуле потоков;
+        для промпта, на котором генерация упала и так, возвращается None.
+        """
+        def safe_generate(prompt):
+            try:
+                return self.generate(prompt, **kwargs)
+            except Exception as e:
+                logger.error(f"Ошибка генерации: {e}")
+                return None
+
+        results = []
+        for start in range(0, len(prompts), max(1, batch_size)):
+            batch = prompts[start:start + max(1, batch_size)]
+            try:
+                results.extend(self.generate_batch(batch, **kwargs))
+            except Exception as e:
+                logger.warning(f"Ошибка пакетной генерации, промпты генерируются по одному: {e}")
+                with ThreadPoolExecutor(max_workers=max(1, min(workers, len(batch)))) as executor:
+                    results.extend(executor.map(safe_generate, batch))
+        return results
+
+
+# Общий экземпляр модели на процесс: веса загружаются один раз и используются всеми обработчиками
+_shared_model = None
+_shared_model_lock = threading.Lock()
+
+def get_model() -> Model:
+    """Возвращает общий для процесса экземпляр Model, загружая его при первом обращении"""
+    global _shared_model
+    if _shared_model is None:
+        with _shared_model_lock:
+            if _shared_model is None:
+                logger.info("Загрузка общей модели...")
+                _shared_model = Model()
+    return _shared_model
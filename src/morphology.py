@@ -1,14 +1,16 @@
 import re
 import logging
+from functools import lru_cache
 import pymorphy3
 
 logger = logging.getLogger(__name__)
 morph = pymorphy3.MorphAnalyzer()
 
+@lru_cache(maxsize=100_000)
 def normalize_term(term: str) -> str:
     words = re.findall(r"[a-zA-Zа-яА-ЯёЁ]+", term)
     clean = [w for w in words if len(w) > 2]
     joined = ' '.join(clean)
     joined = re.sub(r'[Тт]овар:? ?', '', joined)
-    logger.info(f"Normalized term: {joined}")
+    logger.info("Normalized term: %s", joined)
     return joined
\ No newline at end of file
@@ -3,12 +3,33 @@ import json
 from typing import List, Dict
 from urllib.parse import quote
 import logging
+import threading
 import time
+from contextlib import contextmanager
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
 
 logger = logging.getLogger(__name__)
 CACHE_FILE = 'okpd_cache.json'
+CACHE_DIR = '.okpd_cache'
 
 def load_cache():
+    # Кэш на диске (SQLite): каждая запись сохраняется отдельно, без перезаписи всего файла
+    if diskcache is not None:
+        cache = diskcache.Cache(CACHE_DIR)
+        # Переносим записи из прежнего JSON-кэша при первом запуске
+        if len(cache) == 0 and os.path.exists(CACHE_FILE):
+            try:
+                for key, value in json.load(open(CACHE_FILE, encoding='utf-8')).items():
+                    cache[key] = value
+                logger.info(f"Migrated {len(cache)} entries from {CACHE_FILE}")
+            except Exception as e:
+                logger.error(f"Error migrating cache: {e}")
+        return cache
+
     if os.path.exists(CACHE_FILE):
         try:
             return json.load(open(CACHE_FILE, encoding='utf-8'))
@@ -16,7 +37,10 @@ def load_cache():
             logger.error(f"Error loading cache: {e}")
     return {}
 
-def save_cache(cache: dict):
+def save_cache(cache):
+    # Записи diskcache уже на диске
+    if diskcache is not None and isinstance(cache, diskcache.Cache):
+        return
     try:
         json.dump(cache, open(CACHE_FILE, 'w', encoding='utf-8'), ensure_ascii=False, indent=2)
     except Exception as e:
@@ -24,6 +48,90 @@ def save_cache(cache: dict):
 
 CACHE = load_cache()
 
+FALLBACK_ENTRY = {"code": "32.99.59.000", "name": "Изделия различные прочие, не включенные в другие группировки"}
+
+# Запросы к сайту и запись кэша из нескольких потоков выполняются по очереди:
+# сайт не получает параллельных запросов, JSON-кэш не сохраняется во время изменения
+_fetch_lock = threading.Lock()
+
+# Браузер, открытый okpd2_session() в текущем потоке (объекты Playwright sync API привязаны к потоку)
+_session = threading.local()
+
+@contextmanager
+def okpd2_session():
+    """
+    Держит браузер открытым для всех вызовов fetch_okpd2_batch внутри блока в этом потоке.
+    
+    Без сессии каждый вызов с промахами кэша запускает и закрывает свой Chromium;
+    в сессии браузер запускается при первом промахе и закрывается при выходе из блока.
+    Вложенные блоки используют внешнюю сессию.
+    """
+    if getattr(_session, 'active', False):
+        yield
+        return
+    
+    _session.active = True
+    _session.page = None
+    _session.close = None
+    try:
+        yield
+    finally:
+        close = _session.close
+        _session.active = False
+        _session.page = None
+        _session.close = None
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                logger.warning(f"Error closing browser: {e}")
+
+def _launch_page():
+    """Запускает Chromium и возвращает (страница, функция закрытия браузера)"""
+    from playwright.sync_api import sync_playwright
+    
+    pw = sync_playwright().start()
+    try:
+        browser = pw.chromium.launch(headless=True)
+        page = browser.new_page()
+    except BaseException:
+        pw.stop()
+        raise
+    
+    def close():
+        try:
+            browser.close()
+        finally:
+            pw.stop()
+    
+    return page, close
+
+def _acquire_page():
+    """
+    Возвращает (страница, функция освобождения) для одного вызова fetch_okpd2_batch.
+    
+    В сессии okpd2_session() страница общая и освобождение ее не закрывает.
+    """
+    if not getattr(_session, 'active', False):
+        return _launch_page()
+    
+    if _session.page is None or _session.page.is_closed():
+        if _session.close is not None:
+            try:
+                _session.close()
+            except Exception as e:
+                logger.warning(f"Error closing browser: {e}")
+            _session.close = None
+        _session.page, _session.close = _launch_page()
+    return _session.page, lambda: None
+
+def _use_fallback(results, terms):
+    """Записывает общий код-заглушку для терминов, по которым не удалось получить данные"""
+    for term in terms:
+        results[term] = [dict(FALLBACK_ENTRY)]
+        CACHE[term] = results[term]
+        save_cache(CACHE)
+
 def fetch_okpd2_batch(terms: List[str], timeout: int = 15000) -> Dict[str, List[Dict[str,str]]]:
     results = {}
     
@@ -44,67 +152,69 @@ def fetch_okpd2_batch(terms: List[str], timeout: int = 15000) -> Dict[str, List[
     if not remaining_terms:
         return results
     
+    with _fetch_lock:
+        # Пока поток ждал, часть терминов могла загрузить другой поток
+        for term in remaining_terms:
+            if term in CACHE:
+                results[term] = CACHE[term]
+        remaining_terms = [t for t in remaining_terms if t not in results]
+        if remaining_terms:
+            _fetch_remaining(results, remaining_terms, timeout)
+    
+    return results
+
+def _fetch_remaining(results, remaining_terms, timeout):
+    """Загружает с сайта коды для терминов, которых нет в кэше, и дописывает их в results"""
     # Try to use playwright for remaining terms
     try:
-        from playwright.sync_api import sync_playwright
-        
-        with sync_playwright() as pw:
+        page, release = _acquire_page()
+    except ImportError as e:
+        logger.error(f"Playwright import error: {e}")
+        # Use fallbacks for all remaining terms
+        _use_fallback(results, remaining_terms)
+        return
+    except Exception as e:
+        logger.error(f"Browser error: {e}")
+        _use_fallback(results, remaining_terms)
+        return
+    
+    try:
+        for term in remaining_terms:
+            url = f"https://zakupki44fz.ru/app/okpd2/search/{quote(term)}"
             try:
-                browser = pw.chromium.launch(headless=True)
-                page = browser.new_page()
+                logger.info(f"Fetching OKPD2 for {term}")
+                page.goto(url, timeout=timeout)
+                page.wait_for_selector(".okpd2-modal-search-result__item-body", timeout=timeout)
                 
-                for term in remaining_terms:
-                    url = f"https://zakupki44fz.ru/app/okpd2/search/{quote(term)}"
-                    try:
-                        logger.info(f"Fetching OKPD2 for {term}")
-                        page.goto(url, timeout=timeout)
-                        page.wait_for_selector(".okpd2-modal-search-result__item-body", timeout=timeout)
-                        
-                        # Get all the codes and names
-                        codes = page.query_selector_all("div.classifier-code-wrapper > a")
-                        names = page.query_selector_all("div.okpd2-search-container__result-item-name")
-                        
-                        items = []
-                        for c, n in zip(codes, names):
-                            items.append({'code': c.inner_text().strip(), 'name': n.inner_text().strip()})
-                        
-                        if items:
-                            CACHE[term] = items
-                            save_cache(CACHE)
-                            results[term] = items
-                        else:
-                            # If no items found, use general fallback
-                            results[term] = [{"code": "32.99.59.000", "name": "Изделия различные прочие, не включенные в другие группировки"}]
-                            CACHE[term] = results[term]
-                            save_cache(CACHE)
-                        
-                        time.sleep(1)  # Be nice to the server
-                        
-                    except Exception as e:
-                        logger.warning(f"Fetch error for {term}: {e}")
-                        # Use general fallback for errors
-                        results[term] = [{"code": "32.99.59.000", "name": "Изделия различные прочие, не включенные в другие группировки"}]
-                        CACHE[term] = results[term]
-                        save_cache(CACHE)
+                # Get all the codes and names
+                codes = page.query_selector_all("div.classifier-code-wrapper > a")
+                names = page.query_selector_all("div.okpd2-search-container__result-item-name")
                 
-                browser.close()
+                items = []
+                for c, n in zip(codes, names):
+                    items.append({'code': c.inner_text().strip(), 'name': n.inner_text().strip()})
                 
-            except Exception as e:
-                logger.error(f"Browser error: {e}")
-                # Use fallbacks for all remaining terms
-                for term in remaining_terms:
-                    if term not in results:
-                        results[term] = [{"code": "32.99.59.000", "name": "Изделия различные прочие, не включенные в другие группировки"}]
-                        CACHE[term] = results[term]
-                        save_cache(CACHE)
+                if items:
+                    CACHE[term] = items
+                    save_cache(CACHE)
+                    results[term] = items
+                else:
+                    # If no items found, use general fallback
+                    _use_fallback(results, [term])
                 
-    except ImportError as e:
-        logger.error(f"Playwright import error: {e}")
-        # Use fallbacks for all remaining terms
-        for term in remaining_terms:
-            if term not in results:
-                results[term] = [{"code": "32.99.59.000", "name": "Изделия различные прочие, не включенные в другие группировки"}]
-                CACHE[term] = results[term]
-                save_cache(CACHE)
+                time.sleep(1)  # Be nice to the server
+                
+            except Exception as e:
+                logger.warning(f"Fetch error for {term}: {e}")
+                # Use general fallback for errors
+                _use_fallback(results, [term])
     
-    return results
\ No newline at end of file
+    except Exception as e:
+        logger.error(f"Browser error: {e}")
+        # Use fallbacks for all remaining terms
+        _use_fallback(results, [t for t in remaining_terms if t not in results])
+        # Следующий вызов в сессии запустит браузер заново
+        if getattr(_session, 'active', False) and _session.page is page:
+            _session.page = None
+    finally:
+        release()
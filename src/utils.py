@@ -1,9 +1,11 @@
 import re
+from functools import lru_cache
 
 def extract_code(text: str) -> str:
     match = re.search(r"\b\d+(?:\.\d+){1,}\b", text)
     return match.group(0) if match else ''
 
 
+@lru_cache(maxsize=10_000)
 def remove_links(text: str) -> str:
     return re.sub(r'https?://\S+', '', text)
\ No newline at end of file
@@ -4,12 +4,31 @@ import time
 from typing import List
 import logging
 
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
 logger = logging.getLogger(__name__)
 CACHE_PATH = 'duckduckgo_cache.json'
+CACHE_DIR = '.web_cache'
 REQUEST_DELAY = 5
 MAX_RETRIES = 3
 
 def load_cache():
+    # Кэш на диске (SQLite): каждая запись сохраняется отдельно, без перезаписи всего файла
+    if diskcache is not None:
+        cache = diskcache.Cache(CACHE_DIR)
+        # Переносим записи из прежнего JSON-кэша при первом запуске
+        if len(cache) == 0 and os.path.exists(CACHE_PATH):
+            try:
+                for key, value in json.load(open(CACHE_PATH, encoding='utf-8')).items():
+                    cache[key] = value
+                logger.info(f"Migrated {len(cache)} entries from {CACHE_PATH}")
+            except Exception as e:
+                logger.error(f"Error migrating cache: {e}")
+        return cache
+
     if os.path.exists(CACHE_PATH):
         try:
             return json.load(open(CACHE_PATH, encoding='utf-8'))
@@ -17,8 +36,10 @@ def load_cache():
             logger.error(f"Error loading cache: {e}")
     return {}
 
-
-def save_cache(cache: dict):
+def save_cache(cache):
+    # Записи diskcache уже на диске
+    if diskcache is not None and isinstance(cache, diskcache.Cache):
+        return
     try:
         json.dump(cache, open(CACHE_PATH, 'w', encoding='utf-8'), ensure_ascii=False, indent=2)
     except Exception as e:
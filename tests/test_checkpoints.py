@@ -0,0 +1,172 @@
+"""
+Продолжение обработки полного формата по чекпоинту кодов и кэшу упрощенных названий
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import openpyxl
+
+ITEMS = ["Болт М1", "Болт М2", "Болт М3"]
+
+
+class _InputFile:
+    """Загруженный файл в том виде, в каком его передает Gradio (нужен только атрибут name)"""
+
+    def __init__(self, name):
+        self.name = name
+
+
+class _FakeModel:
+    """Модель, которая возвращает название без изменений и запоминает упрощенные названия"""
+
+    def __init__(self):
+        self.simplified = []
+
+    def generate_many(self, prompts, workers=4, **kwargs):
+        terms = [prompt[-1]["content"].split("Название: ", 1)[1].split("\n", 1)[0] for prompt in prompts]
+        self.simplified.extend(terms)
+        return [{"content": term} for term in terms]
+
+
+class _FakeProcessor:
+    """Замена main.Processor: код выбирается без модели и веб-поиска, выбранные названия запоминаются"""
+
+    decided = []
+    on_decide = None
+
+    @staticmethod
+    def _search_context(original):
+        return None
+
+    @staticmethod
+    def _decide_many(processor, requests):
+        if _FakeProcessor.on_decide is not None:
+            _FakeProcessor.on_decide(processor)
+        originals = [original for _, original, _, _ in requests]
+        _FakeProcessor.decided.extend(originals)
+        return [(f"code:{original}", "Название", "") for original in originals]
+
+
+class CheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        # Процессоры пишут processor.log в текущий каталог
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        self.addCleanup(os.chdir, cwd)
+        # Общий каталог чекпоинтов, как CHECKPOINT_DIR в app.py
+        self.cache_dir = os.path.join(self.tmp_dir, "checkpoints")
+
+        _FakeProcessor.decided = []
+        _FakeProcessor.on_decide = None
+        patches = [
+            mock.patch("processors.full_format_processor.Processor", _FakeProcessor),
+            mock.patch("processors.full_format_processor.group_similar", lambda texts: [[text] for text in texts]),
+            mock.patch("processors.full_format_processor.normalize_term", lambda text: text.lower()),
+            mock.patch(
+                "processors.full_format_processor.fetch_okpd2_batch",
+                lambda terms: {term: [{"code": "25.94", "name": "Изделия крепежные"}] for term in terms}
+            ),
+            mock.patch("processors.full_format_processor.GROUP_BATCH_SIZE", 1),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.input_path = os.path.join(self.tmp_dir, "form_4_1.xlsx")
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(["Форма 4.1"])
+        sheet.append([])
+        sheet.append(["№", "Наименование", "Код ОКП/ОКПД2"])
+        for i, item in enumerate(ITEMS, start=1):
+            sheet.append([i, item, None])
+        workbook.save(self.input_path)
+
+    def make_processor(self, model=None):
+        """Процессор одной обработки: промежуточный xlsx в собственном каталоге, как в app.py"""
+        from processors.full_format_processor import FullFormatProcessor
+
+        job_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        processor = FullFormatProcessor(_InputFile(self.input_path), os.path.join(job_dir, "checkpoint.xlsx"),
+                                        save_interval=1, preserve_formatting=False, cache_dir=self.cache_dir)
+        processor.NUM_HEADER_ROWS = 2
+        processor.model = model or _FakeModel()
+        processor.init_model = lambda: True
+        return processor
+
+    def result_codes(self, processor):
+        result = openpyxl.load_workbook(processor.output_path)
+        return {row[1]: row[2] for row in result.active.iter_rows(min_row=4, values_only=True)}
+
+    def codes_checkpoints(self):
+        return [name for name in os.listdir(self.cache_dir) if name.endswith(".jsonl")]
+
+    def test_restarted_job_resumes_from_codes_checkpoint(self):
+        # Первый запуск останавливается, когда начинается выбор кода для второй группы
+        def stop_on_second_group(processor):
+            if _FakeProcessor.decided:
+                processor.stop_event.set()
+
+        _FakeProcessor.on_decide = stop_on_second_group
+        first = self.make_processor()
+        list(first.process())
+        self.assertEqual(_FakeProcessor.decided, ITEMS[:2])
+        self.assertEqual(len(self.codes_checkpoints()), 1)
+
+        # Повторный запуск в другом каталоге обработки берет код первой группы из чекпоинта
+        _FakeProcessor.decided = []
+        _FakeProcessor.on_decide = None
+        second = self.make_processor()
+        list(second.process())
+
+        self.assertEqual(_FakeProcessor.decided, ITEMS[1:])
+        self.assertEqual(self.result_codes(second), {item: f"code:{item}" for item in ITEMS})
+        # После успешной записи результата чекпоинт больше не нужен
+        self.assertEqual(self.codes_checkpoints(), [])
+
+
+    def test_codes_checkpoint_rows_are_skipped(self):
+        writer = self.make_processor()
+        self.assertEqual(writer._load_codes_checkpoint(), {})
+        writer._flush_codes_checkpoint({ITEMS[0]: "11.11"})
+        writer._flush_codes_checkpoint({ITEMS[1]: "22.22"})
+        self.assertEqual(self.make_processor()._load_codes_checkpoint(), {ITEMS[0]: "11.11", ITEMS[1]: "22.22"})
+
+        model = _FakeModel()
+        resumed = self.make_processor(model)
+        list(resumed.process())
+
+        # Модель упрощает и выбирает код только для элемента, которого нет в чекпоинте
+        self.assertEqual(model.simplified, [ITEMS[2].lower()])
+        self.assertEqual(_FakeProcessor.decided, ITEMS[2:])
+        self.assertEqual(
+            self.result_codes(resumed),
+            {ITEMS[0]: "11.11", ITEMS[1]: "22.22", ITEMS[2]: f"code:{ITEMS[2]}"}
+        )
+
+    def test_cached_simplifications_are_reused(self):
+        terms = [item.lower() for item in ITEMS]
+        first = self.make_processor()
+        first._load_simplify_cache()
+        self.assertEqual(first._simplify_terms(terms), terms)
+        first._save_simplify_cache()
+
+        # Кэш в общем каталоге: следующая обработка не обращается к модели за упрощением
+        model = _FakeModel()
+        second = self.make_processor(model)
+        second._load_simplify_cache()
+        self.assertEqual(second._simplify_terms(terms[::-1]), terms[::-1])
+
+        list(second.process())
+        self.assertEqual(model.simplified, [])
+        self.assertEqual(self.result_codes(second), {item: f"code:{item}" for item in ITEMS})
+
+if __name__ == "__main__":
+    unittest.main()
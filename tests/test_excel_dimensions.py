@@ -0,0 +1,131 @@
+"""
+Чтение листов, у которых тег <dimension> в XML указывает неверный размер
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import openpyxl
+
+
+def set_sheet_dimension(path, ref):
+    """Переписывает тег <dimension> первого листа файла path на ref (например, 'A1')"""
+    tmp_path = path + ".tmp"
+    with zipfile.ZipFile(path) as src, zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as dst:
+        for item in src.infolist():
+            data = src.read(item.filename)
+            if item.filename == "xl/worksheets/sheet1.xml":
+                data = re.sub(rb'<dimension ref="[^"]*"', b'<dimension ref="' + ref.encode() + b'"', data)
+            dst.writestr(item, data)
+    os.replace(tmp_path, path)
+
+
+class _InputFile:
+    """Загруженный файл в том виде, в каком его передает Gradio (нужен только атрибут name)"""
+
+    def __init__(self, name):
+        self.name = name
+
+
+class WrongDimensionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        # Процессоры пишут processor.log в текущий каталог
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        self.addCleanup(os.chdir, cwd)
+
+    def make_full_format_file(self, rows=20):
+        path = os.path.join(self.tmp_dir, "form_4_1.xlsx")
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(["Форма 4.1"])
+        sheet.append([])
+        sheet.append(["№", "Наименование", "Код ОКП/ОКПД2"])
+        for i in range(rows):
+            sheet.append([i + 1, f"Болт М{i + 1}", None])
+        workbook.save(path)
+        set_sheet_dimension(path, "A1:B8")
+        return path
+
+    def test_header_rows_ignore_dimension(self):
+        from src.excel_io import read_header_rows
+
+        path = self.make_full_format_file()
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = read_header_rows(workbook, max_row=12, max_col=5)
+        finally:
+            workbook.close()
+
+        self.assertEqual(len(rows), 12)
+        self.assertEqual(rows[2][:3], ("№", "Наименование", "Код ОКП/ОКПД2"))
+        self.assertEqual(rows[11][:2], (9, "Болт М9"))
+
+    def test_streaming_write_keeps_rows_beyond_dimension(self):
+        from processors.full_format_processor import FullFormatProcessor
+
+        path = self.make_full_format_file()
+        processor = FullFormatProcessor(_InputFile(path), os.path.join(self.tmp_dir, "checkpoint.xlsx"),
+                                        preserve_formatting=False)
+        processor.NUM_HEADER_ROWS = 2
+        # Индекс строки + 2 = строка Excel (см. _write_codes_streaming)
+        processor.results_to_update = {
+            ("Sheet", row - 2): {
+                'code': f"25.94.11.{row:03d}",
+                'item': f"Болт М{row - 3}",
+                'normalized': f"болт м{row - 3}",
+                'no_spaces': f"болтм{row - 3}",
+            }
+            for row in (4, 23)
+        }
+
+        self.assertEqual(processor._write_codes_streaming(), 2)
+
+        result = openpyxl.load_workbook(processor.output_path)
+        rows = list(result.active.iter_rows(values_only=True))
+        self.assertEqual(len(rows), 23)
+        self.assertEqual(rows[2][2], "Код ОКП/ОКПД2")
+        self.assertEqual(rows[3][1:3], ("Болт М1", "25.94.11.004"))
+        self.assertEqual(rows[22][1:3], ("Болт М20", "25.94.11.023"))
+
+
+    def test_name_column_scan_reaches_rows_beyond_dimension(self):
+        from processors.full_format_processor import FullFormatProcessor
+
+        path = self.make_full_format_file()
+        processor = FullFormatProcessor(_InputFile(path), os.path.join(self.tmp_dir, "checkpoint.xlsx"))
+        processor.name_column_index = 2
+
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        cell_content_map = {}
+        try:
+            processor._scan_name_column(workbook.active, cell_content_map)
+        finally:
+            workbook.close()
+
+        self.assertEqual(cell_content_map["болт м20"], ("Sheet", 23))
+
+    def test_standard_columns_found_beyond_dimension(self):
+        from processors.standard_processor import StandardProcessor
+
+        path = os.path.join(self.tmp_dir, "standard.xlsx")
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(["№", "Ед.", "Наименование", "Кол-во"])
+        sheet.append([1, "шт", "Болт М1", 10])
+        workbook.save(path)
+        set_sheet_dimension(path, "A1")
+
+        processor = StandardProcessor(_InputFile(path), os.path.join(self.tmp_dir, "checkpoint.xlsx"))
+
+        self.assertTrue(processor._find_columns_in_excel())
+        self.assertEqual(processor.name_column_index, 3)
+
+if __name__ == "__main__":
+    unittest.main()